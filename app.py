@@ -2,41 +2,364 @@ import os
 import time
 import urllib.parse
 import hashlib
+import hmac
 import re
-from flask import Flask, render_template, request, redirect, url_for, flash, Response
+import secrets
+import json
+import shutil
+from flask import Flask, render_template, request, redirect, url_for, flash, Response, jsonify, g, has_request_context, session, send_file
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FsaSession
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from datetime import datetime
-from sqlalchemy import func
+from datetime import datetime, date, timedelta
+from sqlalchemy import func, or_, and_, event, inspect, text, union_all, literal
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import selectinload, aliased
 import csv
 import io
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+import zlib
+import click
+import numpy as np
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your_secret_key'
 
 # --- 資料庫連線 (Render / Local 自動切換) ---
-database_url = os.environ.get('DATABASE_URL')
-if database_url and database_url.startswith("postgres://"):
-    database_url = database_url.replace("postgres://", "postgresql://")
+def normalize_db_url(url):
+    if url and url.startswith("postgres://"): url = url.replace("postgres://", "postgresql://")
+    return url
 
-app.config['SQLALCHEMY_DATABASE_URI'] = database_url or 'sqlite:///finance.db'
+def engine_options(url):
+    # SQLite 用預設值；其他資料庫依環境變數調整連線池
+    if url.startswith('sqlite'): return {}
+    return {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': True,
+    }
+
+database_url = normalize_db_url(os.environ.get('DATABASE_URL')) or 'sqlite:///finance.db'
+replica_url = normalize_db_url(os.environ.get('DATABASE_REPLICA_URL'))
+
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(database_url)
+if replica_url: app.config['SQLALCHEMY_BINDS'] = {'replica': {'url': replica_url, **engine_options(replica_url)}}
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['MAX_CONTENT_LENGTH'] = 64 * 1024 * 1024 # CSV 匯入上限
+app.config['REPLICA_STICKY_SECONDS'] = int(os.environ.get('REPLICA_STICKY_SECONDS', 10)) # 寫入後這段時間內仍讀主庫，確保讀到自己的寫入
+
+class RoutingSession(FsaSession):
+    # 標記為 replica_reads 的路由，其 SELECT 送往唯讀副本；寫入與 flush 一律走主庫
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and getattr(clause, 'is_select', False) and has_request_context() and g.get('use_replica'):
+            return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
 
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 login_manager.login_message = "請先登入以存取該頁面"
 login_manager.login_message_category = "warning"
 
-# --- 綠界測試環境設定 ---
-ECPAY_MERCHANT_ID = '2000132'
-ECPAY_HASH_KEY = '5294y06JbISpM5x9'
-ECPAY_HASH_IV = 'v77hoKGq4kWxNNIS'
-ECPAY_ACTION_URL = 'https://payment-stage.ecpay.com.tw/Cashier/AioCheckOut/V5'
+# --- 綠界設定 (預設為測試環境) ---
+ECPAY_MERCHANT_ID = os.environ.get('ECPAY_MERCHANT_ID', '2000132')
+ECPAY_HASH_KEY = os.environ.get('ECPAY_HASH_KEY', '5294y06JbISpM5x9')
+ECPAY_HASH_IV = os.environ.get('ECPAY_HASH_IV', 'v77hoKGq4kWxNNIS')
+ECPAY_ACTION_URL = os.environ.get('ECPAY_ACTION_URL', 'https://payment-stage.ecpay.com.tw/Cashier/AioCheckOut/V5')
+ECPAY_RETURN_URL = os.environ.get('ECPAY_RETURN_URL') # 綠界伺服器回呼網址；未設定時依目前網域產生 /ecpay/notify
+PREMIUM_PRICE = 100
+
+# --- 請求範圍的使用者載入與查詢預算 ---
+class QueryBudgetExceeded(RuntimeError): pass
+
+def user_context(*relationships, max_queries=None):
+    # 宣告路由需要預先載入的 User 關聯 (selectin) 與每次請求的 SQL 查詢上限
+    # max_queries 可為整數或 {'GET': n, 'POST': m}；需放在 @login_required 之下，屬性才會被 functools.wraps 帶到外層
+    def decorator(f):
+        f.user_loads = relationships
+        f.query_budget = max_queries
+        return f
+    return decorator
+
+def replica_reads(f):
+    # 唯讀的 GET 路由可改讀副本 (需設定 DATABASE_REPLICA_URL)
+    f.use_replica = True
+    return f
+
+def read_primary():
+    # 讀到的資料要寫回主庫時 (例如懶重建彙總)，這次請求之後的查詢改讀主庫，不把副本的舊資料寫進去
+    if has_request_context(): g.use_replica = False
+
+def primary_sticky_until():
+    return datetime.utcnow() + timedelta(seconds=app.config['REPLICA_STICKY_SECONDS'])
+
+def mark_primary_sticky(user_id):
+    # 讀自己寫入的保證記在 User 上 (伺服器端)，背景工作與金流回呼的寫入也適用，不依賴發出寫入的那個瀏覽器 cookie
+    db.session.execute(db.update(User).where(User.id == user_id).values(primary_until=primary_sticky_until()))
+
+@app.before_request
+def route_reads_to_replica():
+    # 先標記為候選，load_user 從主庫讀到 primary_until 後再決定
+    if replica_url and request.method == 'GET' and getattr(current_view(), 'use_replica', False): g.use_replica = True
+
+def current_view():
+    return app.view_functions.get(request.endpoint) if has_request_context() and request.endpoint else None
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # User 一律讀主庫：副本延遲時 primary_until 與 data_version (ETag) 也可能是舊的
+    replica = g.pop('use_replica', False)
+    loads = getattr(current_view(), 'user_loads', ())
+    if not loads: user = db.session.get(User, int(user_id))
+    else:
+        q = db.select(User).filter_by(id=int(user_id)).options(*[selectinload(getattr(User, r)) for r in loads])
+        user = db.session.execute(q).scalar_one_or_none()
+    if replica and not (user and user.primary_until and user.primary_until > datetime.utcnow()): g.use_replica = True
+    return user
+
+@app.after_request
+def enforce_query_budget(response):
+    budget = getattr(current_view(), 'query_budget', None)
+    if isinstance(budget, dict): budget = budget.get(request.method)
+    used = g.get('query_count', 0)
+    if budget is not None and used > budget:
+        msg = f"{request.endpoint} used {used} queries (budget {budget})"
+        if app.config.get('QUERY_BUDGET_STRICT', app.testing): raise QueryBudgetExceeded(msg)
+        app.logger.warning(msg)
+    return response
+
+# --- 監控：SQL / 請求計時、/metrics 與慢查詢紀錄 ---
+app.config.setdefault('METRICS_TOKEN', os.environ.get('METRICS_TOKEN')) # 未設定時 /metrics 只接受本機直接連線；設定後需帶 Authorization: Bearer <token>
+app.config.setdefault('METRICS_DIR', os.environ.get('METRICS_DIR', os.path.join(app.instance_path, 'metrics'))) # 同一台主機上所有 worker 共用；部署新版時清空
+app.config.setdefault('METRICS_FLUSH_SECONDS', 1.0)
+app.config.setdefault('SLOW_QUERY_MS', float(os.environ.get('SLOW_QUERY_MS', 200)))
+app.config.setdefault('SLOW_REQUEST_MS', float(os.environ.get('SLOW_REQUEST_MS', 1000)))
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_MAX_STATEMENTS = 500
+
+class Histogram:
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS); self.total = 0.0; self.count = 0
+
+    def observe(self, seconds):
+        self.count += 1; self.total += seconds
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound: self.counts[i] += 1; break
+
+    def dump(self): return [self.counts, self.total, self.count]
+
+    def merge(self, data):
+        counts, total, count = data
+        self.counts = [a + b for a, b in zip(self.counts, counts)]; self.total += total; self.count += count
+        return self
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.counts):
+            cumulative += n
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {self.count}'
+        yield f'{name}_sum{{{labels}}} {self.total:.6f}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+class Metrics:
+    # 每個程序各自累計，定期把快照寫到 METRICS_DIR；/metrics 不論落在哪個 worker 都合併所有快照輸出
+    # 已結束的 worker 快照保留，計數器才不會倒退
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # fork 後子程序從零開始，不重複計入 master 的數字；檔名含隨機碼，pid 重用時不會覆蓋舊 worker 的快照
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.request_latency = {}
+        self.request_queries = {}
+        self.sql_latency = {}
+        self._file = f'metrics-{os.getpid()}-{secrets.token_hex(4)}.json'
+        self._dirty, self._flushed = False, 0.0
+
+    def observe_request(self, endpoint, method, status, seconds, queries):
+        with self._lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.request_latency.setdefault(endpoint, Histogram()).observe(seconds)
+            self.request_queries[endpoint] = self.request_queries.get(endpoint, 0) + queries
+            self._dirty = True
+
+    def observe_query(self, statement, seconds):
+        with self._lock:
+            hist = self.sql_latency.get(statement)
+            if hist is None:
+                if len(self.sql_latency) >= METRICS_MAX_STATEMENTS: statement = 'other'
+                hist = self.sql_latency.setdefault(statement, Histogram())
+            hist.observe(seconds)
+            self._dirty = True
+
+    def snapshot(self):
+        with self._lock:
+            self._dirty = False
+            return {'requests': [[e, m, st, n] for (e, m, st), n in self.requests.items()],
+                    'request_latency': {e: h.dump() for e, h in self.request_latency.items()},
+                    'request_queries': dict(self.request_queries),
+                    'sql_latency': {stmt: h.dump() for stmt, h in self.sql_latency.items()}}
+
+    def flush(self, force=False):
+        # 最多每 METRICS_FLUSH_SECONDS 寫一次；先寫暫存檔再 rename，讀取端不會讀到寫一半的檔案
+        if not self._dirty or (not force and time.monotonic() - self._flushed < app.config['METRICS_FLUSH_SECONDS']): return
+        self._flushed = time.monotonic()
+        path = os.path.join(app.config['METRICS_DIR'], self._file)
+        try:
+            os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+            with open(path + '.tmp', 'w', encoding='utf-8') as f: json.dump(self.snapshot(), f, ensure_ascii=False)
+            os.replace(path + '.tmp', path)
+        except OSError as e: app.logger.warning(f"metrics flush failed: {e}")
+
+    def collect(self):
+        requests, latency, queries, sql = {}, {}, {}, {}
+        directory = app.config['METRICS_DIR']
+        for name in sorted(os.listdir(directory)) if os.path.isdir(directory) else ():
+            if not name.endswith('.json'): continue
+            try:
+                with open(os.path.join(directory, name), encoding='utf-8') as f: snap = json.load(f)
+            except (OSError, ValueError): continue
+            for e, m, st, n in snap['requests']: requests[(e, m, st)] = requests.get((e, m, st), 0) + n
+            for e, h in snap['request_latency'].items(): latency.setdefault(e, Histogram()).merge(h)
+            for e, n in snap['request_queries'].items(): queries[e] = queries.get(e, 0) + n
+            for stmt, h in snap['sql_latency'].items(): sql.setdefault(stmt, Histogram()).merge(h)
+        return requests, latency, queries, sql
+
+    def render(self):
+        def esc(v): return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+        self.flush(force=True)
+        requests, latency, queries, sql = self.collect()
+        out = ['# TYPE finance_http_requests_total counter']
+        out += [f'finance_http_requests_total{{endpoint="{esc(e)}",method="{m}",status="{st}"}} {n}' for (e, m, st), n in sorted(requests.items())]
+        out.append('# TYPE finance_http_request_duration_seconds histogram')
+        for e, h in sorted(latency.items()): out += h.lines('finance_http_request_duration_seconds', f'endpoint="{esc(e)}"')
+        out.append('# TYPE finance_http_request_queries_total counter')
+        out += [f'finance_http_request_queries_total{{endpoint="{esc(e)}"}} {n}' for e, n in sorted(queries.items())]
+        out.append('# TYPE finance_sql_query_duration_seconds histogram')
+        for stmt, h in sorted(sql.items()): out += h.lines('finance_sql_query_duration_seconds', f'statement="{esc(stmt)}"')
+        return '\n'.join(out) + '\n'
+
+metrics = Metrics()
+if hasattr(os, 'register_at_fork'): os.register_at_fork(after_in_child=metrics.reset)
+
+@lru_cache(maxsize=2048)
+def normalize_sql(statement):
+    # 去掉字面值與 IN 清單長度，讓同一種查詢歸在同一組
+    sql = re.sub(r"'(?:[^']|'')*'", '?', statement)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    sql = re.sub(r'\(\s*(?:\?|%\(\w+\)s|:\w+)(?:\s*,\s*(?:\?|%\(\w+\)s|:\w+))*\s*\)', '(?)', sql)
+    sql = re.sub(r'(?:%\(\w+\)s|:\w+)', '?', sql)
+    return re.sub(r'\s+', ' ', sql).strip()[:200]
+
+def request_user_id(): return session.get('_user_id') # 直接讀 session，避免在計時 hook 中觸發 load_user 查詢
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_query(conn, cursor, statement, parameters, context, executemany):
+    # 開始時間記在這次執行的 context 上；失敗的查詢不會觸發 after_cursor_execute，也不會在連線上殘留資料
+    if context is not None: context._finance_query_start = time.perf_counter()
+    if has_request_context(): g.query_count = g.get('query_count', 0) + 1
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_query(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_finance_query_start', None)
+    if start is None: return
+    elapsed = time.perf_counter() - start
+    metrics.observe_query(normalize_sql(statement), elapsed)
+    if elapsed * 1000 >= app.config['SLOW_QUERY_MS']:
+        where = f"endpoint={request.endpoint} user={request_user_id()}" if has_request_context() else "endpoint=- user=-"
+        app.logger.warning(f"slow query {elapsed * 1000:.1f}ms {where}: {normalize_sql(statement)}")
+
+@app.before_request
+def start_request_timer(): g.request_start = time.perf_counter()
+
+def record_request(status):
+    if 'request_start' not in g or g.get('request_recorded'): return
+    g.request_recorded = True
+    elapsed = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or 'unknown'
+    metrics.observe_request(endpoint, request.method, status, elapsed, g.get('query_count', 0)); metrics.flush()
+    if elapsed * 1000 >= app.config['SLOW_REQUEST_MS']:
+        app.logger.warning(f"slow request {elapsed * 1000:.1f}ms endpoint={endpoint} user={request_user_id()} {request.method} {request.full_path} queries={g.get('query_count', 0)}")
+
+@app.after_request
+def finish_request_timer(response):
+    record_request(response.status_code); return response
+
+@app.teardown_request
+def finish_failed_request(exc):
+    if exc is not None: record_request(500)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # 內容含 SQL 與路由名稱，預設不對外：未設定 METRICS_TOKEN 時只接受本機且未經反向代理的連線
+    token = app.config.get('METRICS_TOKEN')
+    if token: allowed = hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode())
+    else: allowed = request.remote_addr in ('127.0.0.1', '::1') and 'X-Forwarded-For' not in request.headers
+    if not allowed: return Response('forbidden\n', status=403, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# --- 頁面快取 (ETag / 304 與渲染結果 LRU) ---
+app.config.setdefault('RENDER_CACHE_SIZE', 256)
+app.config.setdefault('RENDER_CACHE_BACKEND', None) # 任何具備 get(key) / set(key, value) 的物件，例如包裝 Redis 的 adapter
+app.config.setdefault('PAGE_BUILD_ID', os.environ.get('RENDER_GIT_COMMIT', '')) # 部署新版模板時讓瀏覽器端的 ETag 失效
+
+class RenderCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None: self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value; self._data.move_to_end(key)
+            while len(self._data) > self.max_entries: self._data.popitem(last=False)
+
+_render_cache = None
+
+def get_render_cache():
+    global _render_cache
+    if _render_cache is None: _render_cache = app.config['RENDER_CACHE_BACKEND'] or RenderCache(app.config['RENDER_CACHE_SIZE'])
+    return _render_cache
+
+def cached_page(render, *key_parts):
+    # key 含使用者的 data_version，任何寫入後自動失效；未變動時只花 load_user 一次查詢
+    key = '|'.join(str(p) for p in (request.endpoint, current_user.id, current_user.data_version, app.config['PAGE_BUILD_ID'], *key_parts))
+    etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag): resp = Response(status=304)
+    else:
+        cache = get_render_cache()
+        html = cache.get(key)
+        if html is None:
+            # 副本尚未追上這個 data_version 時改讀主庫，舊資料才不會以新版本的 key/ETag 被快取
+            if g.get('use_replica') and db.session.query(User.data_version).filter_by(id=current_user.id).scalar() != current_user.data_version: read_primary()
+            html = render(); cache.set(key, html)
+        resp = Response(html, mimetype='text/html')
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
+
+def touch_user(user_id):
+    # 每個寫入 (含背景工作與金流回呼) 在 commit 前呼叫，讓該使用者的 ETag 與頁面快取失效，並在 REPLICA_STICKY_SECONDS 內改讀主庫
+    return db.session.execute(db.update(User).where(User.id == user_id).values(data_version=User.data_version + 1, primary_until=primary_sticky_until())
+                              .returning(User.data_version)).scalar()
 
 # --- 資料庫模型 ---
 class User(UserMixin, db.Model):
@@ -47,6 +370,8 @@ class User(UserMixin, db.Model):
     bio = db.Column(db.String(200))
     fire_target = db.Column(db.Integer, default=10000000)
     is_premium = db.Column(db.Boolean, default=False) 
+    data_version = db.Column(db.Integer, nullable=False, default=0, server_default='0') # 每次寫入遞增，用於 ETag / 頁面快取
+    primary_until = db.Column(db.DateTime) # 最近一次寫入後，此時間之前的讀取都走主庫
     
     transactions = db.relationship('Transaction', backref='owner', lazy=True)
     subscriptions = db.relationship('Subscription', backref='owner', lazy=True)
@@ -68,6 +393,7 @@ class Order(db.Model):
     status = db.Column(db.String(20), default="Pending") # Pending, Paid
     date_created = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    __table_args__ = (db.Index('ix_order_user_status', 'user_id', 'status'),)
 
 class Transaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -79,18 +405,124 @@ class Transaction(db.Model):
     note = db.Column(db.String(200))
     mood = db.Column(db.String(20), default="neutral") # happy, neutral, regret
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    row_version = db.Column(db.Integer, nullable=False, default=0, server_default='0') # 寫入時的 User.data_version，供同步 API 取差異
+
+    # 月份區間查詢與 keyset 分頁都走 (user_id, date) 前綴
+    # SQLite 需要 AUTOINCREMENT 才不會重用已刪除 (含已封存) 的最大 id；封存資料保留原 id，熱資料與封存資料的 id 必須不重複
+    __table_args__ = (
+        db.Index('ix_transaction_user_date', 'user_id', 'date', 'id'),
+        db.Index('ix_transaction_user_type_date', 'user_id', 'type', 'date'),
+        db.Index('ix_transaction_user_version', 'user_id', 'row_version', 'id'), # 同步 API 依 (row_version, id) 分頁
+        {'sqlite_autoincrement': True},
+    )
+
+class TransactionArchive(db.Model):
+    # 已封存年度的交易 (保留原 id)；Postgres 依 archive_year 做 LIST 分割，每年一個分割表，其他資料庫為單一資料表
+    __tablename__ = 'transaction_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    archive_year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    date = db.Column(db.Date, nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    type = db.Column(db.String(10), nullable=False)
+    main_category = db.Column(db.String(50), nullable=False)
+    item_name = db.Column(db.String(50), nullable=False)
+    note = db.Column(db.String(200))
+    mood = db.Column(db.String(20))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    row_version = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (db.Index('ix_transaction_archive_user_date', 'user_id', 'date', 'id'), db.Index('ix_transaction_archive_user_version', 'user_id', 'row_version', 'id'),
+                      {'postgresql_partition_by': 'LIST (archive_year)'})
+
+class UserBalance(db.Model):
+    # 每位使用者的累計收支，與交易的新增/刪除在同一個 DB transaction 內更新
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    income = db.Column(db.BigInteger, nullable=False, default=0)
+    expense = db.Column(db.BigInteger, nullable=False, default=0)
+    tx_count = db.Column(db.Integer, nullable=False, default=0)
+
+class MonthlyRollup(db.Model):
+    # 每月 x 收支 x 主分類 x 情緒 的金額與筆數，analysis() 直接讀這張表
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    year_month = db.Column(db.String(7), nullable=False) # YYYY-MM
+    type = db.Column(db.String(10), nullable=False)
+    main_category = db.Column(db.String(50), nullable=False)
+    mood = db.Column(db.String(20), nullable=False)
+    total = db.Column(db.BigInteger, nullable=False, default=0)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (db.Index('ux_rollup_key', 'user_id', 'year_month', 'type', 'main_category', 'mood', unique=True),)
+
+class YearlySummary(db.Model):
+    # 封存年度 x 收支 x 主分類 x 情緒 的彙總，內容與 transaction_archive 一致；終身統計不必掃描冷資料
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    type = db.Column(db.String(10), nullable=False)
+    main_category = db.Column(db.String(50), nullable=False)
+    mood = db.Column(db.String(20), nullable=False)
+    total = db.Column(db.BigInteger, nullable=False, default=0)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (db.Index('ux_yearly_summary_key', 'user_id', 'year', 'type', 'main_category', 'mood', unique=True),)
+
+class ArchiveYear(db.Model):
+    # 年度封存進度；rows / amount 為 transaction_archive 內該年度的筆數與金額，與每一批搬移在同一個 DB transaction 內更新
+    year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    status = db.Column(db.String(20), nullable=False, default='running') # running, verified, failed
+    rows = db.Column(db.Integer, nullable=False, default=0)
+    amount = db.Column(db.BigInteger, nullable=False, default=0)
+    error = db.Column(db.String(500))
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
 
 class Subscription(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     amount = db.Column(db.Integer, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    row_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (db.Index('ix_subscription_user_version', 'user_id', 'row_version'),)
 
 class Budget(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     category = db.Column(db.String(50), nullable=False)
     amount = db.Column(db.Integer, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    row_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (db.Index('ix_budget_user_version', 'user_id', 'row_version'),)
+
+class Tombstone(db.Model):
+    # 刪除紀錄，讓離線裝置同步時也能得知哪些資料已被移除
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False) # transaction, budget, subscription
+    object_id = db.Column(db.Integer, nullable=False)
+    row_version = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_tombstone_user_version', 'user_id', 'row_version'),)
+
+class Job(db.Model):
+    # 背景工作佇列：queued -> running -> done / failed；失敗時重新排入 queued 直到用完 attempts
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kind = db.Column(db.String(30), nullable=False)
+    params = db.Column(db.Text, default='{}')
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_at = db.Column(db.DateTime)
+    result = db.Column(db.Text)
+    result_name = db.Column(db.String(100))
+    error = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    expires_at = db.Column(db.DateTime)
+    __table_args__ = (db.Index('ix_job_status_run_after', 'status', 'run_after'), db.Index('ix_job_user_status', 'user_id', 'status'))
 
 class Achievement(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -98,18 +530,36 @@ class Achievement(db.Model):
     description = db.Column(db.String(200))
     icon = db.Column(db.String(50)) 
 
+    __table_args__ = (db.Index('ux_achievement_name', 'name', unique=True),)
+
 class UserAchievement(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     achievement_id = db.Column(db.Integer, db.ForeignKey('achievement.id'), nullable=False)
     date_earned = db.Column(db.Date, default=datetime.utcnow)
 
+    __table_args__ = (db.Index('ix_user_achievement_user', 'user_id', 'achievement_id'),)
+
+class SchemaVersion(db.Model):
+    # 已套用的遷移版本，見 MIGRATIONS
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class Feedback(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     message = db.Column(db.String(500), nullable=False)
     date_sent = db.Column(db.DateTime, default=datetime.utcnow)
 
+TX_COLUMNS = ('id', 'user_id', 'date', 'amount', 'type', 'main_category', 'item_name', 'note', 'mood', 'row_version')
+# 熱資料與封存資料的 UNION ALL；查詢條件會下推到兩邊，各自走 (user_id, date) 索引。只用來查欄位，不要查整個 entity
+AllTransaction = aliased(Transaction, union_all(db.select(*[Transaction.__table__.c[c] for c in TX_COLUMNS]),
+                                                db.select(*[TransactionArchive.__table__.c[c] for c in TX_COLUMNS])).subquery('all_transaction'), adapt_on_names=True)
+
+def tx_columns(entity=AllTransaction):
+    return [getattr(entity, c) for c in TX_COLUMNS]
+
 # --- 輔助函式 ---
 def is_password_strong(password):
     if len(password) < 8: return False
@@ -130,88 +580,524 @@ def get_mac_value(params):
     m.update(encoded.encode('utf-8'))
     return m.hexdigest().upper()
 
-def init_achievements():
+def new_trade_no():
+    # 綠界限制 20 碼英數字：FA + 秒級時間 (12) + 隨機 6 碼，同一秒內碰撞機率約 1/1600 萬
+    return f"FA{datetime.now().strftime('%y%m%d%H%M%S')}{secrets.token_hex(3).upper()}"
+
+def verify_ecpay_callback(form):
+    params = form.to_dict()
+    mac = params.pop('CheckMacValue', '')
+    # 以 bytes 比對：compare_digest 遇到非 ASCII 字串會拋出 TypeError
+    return params, hmac.compare_digest(get_mac_value(params).encode(), mac.upper().encode('utf-8')) and params.get('MerchantID') == ECPAY_MERCHANT_ID
+
+def apply_ecpay_payment(trade_no, amount):
+    # 以條件式更新 Pending→Paid，重複或併發的回呼只有一個會成功，其餘視為已處理
+    paid = db.session.execute(db.update(Order).where(Order.trade_no == trade_no, Order.status == 'Pending', Order.amount == amount)
+                              .values(status='Paid').returning(Order.user_id)).scalar()
+    if paid is None:
+        db.session.rollback()
+        return db.session.query(Order.id).filter_by(trade_no=trade_no, status='Paid').first() is not None
+    db.session.execute(db.update(User).where(User.id == paid).values(is_premium=True))
+    touch_user(paid); db.session.commit()
+    return True
+
+def parse_month(month_str):
     try:
-        default_achievements = [
-            {"name": "記帳新手", "desc": "記下你的第一筆帳", "icon": "fa-baby"},
-            {"name": "省錢達人", "desc": "單筆支出小於 50 元", "icon": "fa-piggy-bank"},
-            {"name": "大戶人家", "desc": "單筆收入超過 5000 元", "icon": "fa-crown"},
-            {"name": "訂閱管理者", "desc": "新增一筆訂閱服務", "icon": "fa-calendar-check"},
-            {"name": "預算守門員", "desc": "設定你的第一個預算", "icon": "fa-shield-alt"}
-        ]
-        for ach in default_achievements:
-            if not Achievement.query.filter_by(name=ach['name']).first():
-                db.session.add(Achievement(name=ach['name'], description=ach['desc'], icon=ach['icon']))
-        db.session.commit()
-    except: pass
+        m_year, m_month = map(int, month_str.split('-'))
+        month_range(m_year, m_month) # 連同下個月的起點一起檢查，9999-12 之類的月份不會溢位
+    except (AttributeError, ValueError, OverflowError):
+        today = datetime.now(); m_year, m_month = today.year, today.month
+    return m_year, m_month, f"{m_year:04d}-{m_month:02d}"
 
-# 初始化資料庫
-with app.app_context():
-    # ★★★ 正式上線：請務必將下面這行註解掉 (加上 #)，防止資料被清空 ★★★
-    #db.drop_all() 
-    
+def month_range(m_year, m_month):
+    # 半開區間 [start, end)，可直接使用 (user_id, date) 索引
+    start = date(m_year, m_month, 1)
+    end = date(m_year + 1, 1, 1) if m_month == 12 else date(m_year, m_month + 1, 1)
+    return start, end
+
+ANALYSIS_DETAIL_LIMIT = 200
+LEDGER_PAGE_SIZE = 50
+LEDGER_MAX_PAGE_SIZE = 500
+
+def encode_cursor(t): return f"{t.date.strftime('%Y-%m-%d')}_{t.id}"
+
+def decode_cursor(cursor):
+    try:
+        d, i = cursor.split('_')
+        return datetime.strptime(d, '%Y-%m-%d').date(), int(i)
+    except (AttributeError, ValueError): return None
+
+def ledger_page(user_id, start, end, cursor=None, limit=LEDGER_PAGE_SIZE):
+    # 依 (date desc, id desc) 排序的 keyset 分頁，多取一筆判斷是否還有下一頁；包含已封存的年度
+    T = AllTransaction
+    q = db.session.query(*tx_columns()).filter(T.user_id == user_id, T.date >= start, T.date < end)
+    after = decode_cursor(cursor) if cursor else None
+    if after:
+        c_date, c_id = after
+        q = q.filter(or_(T.date < c_date, and_(T.date == c_date, T.id < c_id)))
+    rows = q.order_by(T.date.desc(), T.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def compute_balance(user_id):
+    # 熱資料直接加總，封存年度改讀 YearlySummary
+    income = expense = count = 0
+    rows = db.session.query(Transaction.type, func.sum(Transaction.amount), func.count(Transaction.id)).filter_by(user_id=user_id).group_by(Transaction.type).all()
+    rows += db.session.query(YearlySummary.type, func.sum(YearlySummary.total), func.sum(YearlySummary.count)).filter_by(user_id=user_id).group_by(YearlySummary.type).all()
+    for t_type, total, n in rows:
+        if t_type == 'income': income += total or 0
+        else: expense += total or 0
+        count += n
+    return income, expense, count
+
+def rebuild_balance(user_id):
+    income, expense, count = compute_balance(user_id)
+    bal = db.session.get(UserBalance, user_id)
+    if bal is None: bal = UserBalance(user_id=user_id); db.session.add(bal)
+    bal.income, bal.expense, bal.tx_count = income, expense, count
+    return bal
+
+def get_balance(user_id):
+    bal = db.session.get(UserBalance, user_id)
+    if bal is None: read_primary(); bal = rebuild_balance(user_id); db.session.commit()
+    return bal
+
+def record_balance(user_id, t_type, amount, count=1):
+    # 增量更新；舊帳號尚無紀錄時，直接從已 flush 的交易重建
+    col = UserBalance.income if t_type == 'income' else UserBalance.expense
+    updated = UserBalance.query.filter_by(user_id=user_id).update({col: col + amount, UserBalance.tx_count: UserBalance.tx_count + count}, synchronize_session=False)
+    if not updated: rebuild_balance(user_id)
+
+def rebuild_month_rollup(user_id, m_year, m_month):
+    start, end = month_range(m_year, m_month)
+    year_month = f"{m_year:04d}-{m_month:02d}"
+    MonthlyRollup.query.filter_by(user_id=user_id, year_month=year_month).delete(synchronize_session=False)
+    T = AllTransaction
+    mood = func.coalesce(T.mood, 'neutral')
+    rows = db.session.query(T.type, T.main_category, mood, func.sum(T.amount), func.count(T.id)).filter(
+        T.user_id == user_id, T.date >= start, T.date < end).group_by(T.type, T.main_category, mood).all()
+    rollups = [dict(user_id=user_id, year_month=year_month, type=t_type, main_category=cat, mood=t_mood, total=total or 0, count=n) for t_type, cat, t_mood, total, n in rows]
+    if rollups: db.session.execute(MonthlyRollup.__table__.insert(), rollups)
+    return [MonthlyRollup(**r) for r in rollups]
+
+def record_rollup(user_id, t_date, t_type, main_category, mood, amount, count=1):
+    # 該月尚未建立彙總時整月重建，避免只寫入差額
+    year_month = t_date.strftime('%Y-%m')
+    updated = MonthlyRollup.query.filter_by(user_id=user_id, year_month=year_month, type=t_type, main_category=main_category, mood=mood or 'neutral').update(
+        {MonthlyRollup.total: MonthlyRollup.total + amount, MonthlyRollup.count: MonthlyRollup.count + count}, synchronize_session=False)
+    if not updated: rebuild_month_rollup(user_id, t_date.year, t_date.month)
+
+def record_transaction(t, sign=1):
+    # 新增 (sign=1) 或刪除 (sign=-1) 交易後，在同一個 DB transaction 內更新所有衍生彙總
+    db.session.flush()
+    record_balance(t.user_id, t.type, sign * t.amount, sign)
+    record_rollup(t.user_id, t.date, t.type, t.main_category, t.mood, sign * t.amount, sign)
+
+def delete_transaction(t, version):
+    # t 可以是 Transaction 或 TransactionArchive；封存資料先扣回年度彙總與封存進度，record_transaction 若需重建餘額才會讀到扣除後的 YearlySummary
+    db.session.delete(t)
+    if isinstance(t, TransactionArchive):
+        YearlySummary.query.filter_by(user_id=t.user_id, year=t.archive_year, type=t.type, main_category=t.main_category, mood=t.mood or 'neutral').update(
+            {YearlySummary.total: YearlySummary.total - t.amount, YearlySummary.count: YearlySummary.count - 1}, synchronize_session=False)
+        ArchiveYear.query.filter_by(year=t.archive_year).update({ArchiveYear.rows: ArchiveYear.rows - 1, ArchiveYear.amount: ArchiveYear.amount - t.amount}, synchronize_session=False)
+    record_transaction(t, sign=-1)
+    record_tombstone(t.user_id, 'transaction', t.id, version)
+
+# --- 冷熱資料封存 (flask archive-years) ---
+app.config.setdefault('ARCHIVE_KEEP_YEARS', int(os.environ.get('ARCHIVE_KEEP_YEARS', 1))) # 今年與前 N 年留在熱資料表
+app.config.setdefault('ARCHIVE_BATCH_SIZE', 5000)
+
+class ArchiveVerificationError(RuntimeError): pass
+
+def archive_cutoff_year(today=None):
+    # 早於此年度的資料可以封存
+    return (today or date.today()).year - app.config['ARCHIVE_KEEP_YEARS']
+
+def ensure_archive_partition(year):
+    if db.session.connection().dialect.name == 'postgresql':
+        db.session.execute(text(f'CREATE TABLE IF NOT EXISTS transaction_archive_{int(year)} PARTITION OF transaction_archive FOR VALUES IN ({int(year)})'))
+
+def rebuild_yearly_summaries(year, user_ids):
+    YearlySummary.query.filter(YearlySummary.year == year, YearlySummary.user_id.in_(user_ids)).delete(synchronize_session=False)
+    A = TransactionArchive
+    mood = func.coalesce(A.mood, 'neutral')
+    rows = [dict(user_id=uid, year=year, type=t_type, main_category=cat, mood=t_mood, total=total or 0, count=n)
+            for uid, t_type, cat, t_mood, total, n in db.session.query(A.user_id, A.type, A.main_category, mood, func.sum(A.amount), func.count(A.id)).filter(
+                A.archive_year == year, A.user_id.in_(user_ids)).group_by(A.user_id, A.type, A.main_category, mood)]
+    if rows: db.session.execute(YearlySummary.__table__.insert(), rows)
+
+def archive_batch(year, limit):
+    # 一批在同一個 DB transaction 內完成：複製 -> 核對筆數與金額 -> 刪除熱資料 -> 更新年度彙總與進度；中斷時整批回滾
+    batch = db.session.query(Transaction.id, Transaction.user_id, Transaction.amount).filter(
+        Transaction.date >= date(year, 1, 1), Transaction.date < date(year + 1, 1, 1)).order_by(Transaction.id).limit(limit).all()
+    if not batch: return 0
+    ids, amount = [r.id for r in batch], sum(r.amount for r in batch)
+    cols = list(TX_COLUMNS)
+    db.session.execute(TransactionArchive.__table__.insert().from_select(cols + ['archive_year'], db.select(*[Transaction.__table__.c[c] for c in cols], literal(year)).where(Transaction.id.in_(ids))))
+    copied = db.session.query(func.count(TransactionArchive.id), func.coalesce(func.sum(TransactionArchive.amount), 0)).filter(
+        TransactionArchive.archive_year == year, TransactionArchive.id.in_(ids)).one()
+    deleted = Transaction.query.filter(Transaction.id.in_(ids)).delete(synchronize_session=False)
+    if tuple(copied) != (len(ids), amount) or deleted != len(ids):
+        db.session.rollback()
+        raise ArchiveVerificationError(f'{year}: batch {ids[0]}..{ids[-1]} expected {len(ids)} rows / {amount}, copied {tuple(copied)}, deleted {deleted}')
+    rebuild_yearly_summaries(year, {r.user_id for r in batch})
+    ArchiveYear.query.filter_by(year=year).update({ArchiveYear.rows: ArchiveYear.rows + len(ids), ArchiveYear.amount: ArchiveYear.amount + amount}, synchronize_session=False)
+    db.session.commit()
+    return len(ids)
+
+def verify_archive_year(year):
+    # 封存表、年度彙總與進度紀錄三者的筆數與金額必須一致
+    archived = tuple(db.session.query(func.count(TransactionArchive.id), func.coalesce(func.sum(TransactionArchive.amount), 0)).filter(TransactionArchive.archive_year == year).one())
+    summary = tuple(db.session.query(func.coalesce(func.sum(YearlySummary.count), 0), func.coalesce(func.sum(YearlySummary.total), 0)).filter(YearlySummary.year == year).one())
+    state = db.session.get(ArchiveYear, year)
+    recorded = (state.rows, state.amount) if state else (0, 0)
+    if not archived == summary == recorded: raise ArchiveVerificationError(f'{year}: archive={archived} summary={summary} recorded={recorded}')
+    return archived
+
+def archive_year(year, batch_size=None, progress=None):
+    # 可重複執行：每批各自 commit，中斷後再次執行會從熱資料表剩下的部分繼續
+    if year >= archive_cutoff_year(): raise ValueError(f'{year} 尚未超過保留年限')
+    state = db.session.get(ArchiveYear, year)
+    if state is None: state = ArchiveYear(year=year); db.session.add(state)
+    state.status, state.error, state.finished_at = 'running', None, None
+    ensure_archive_partition(year); db.session.commit()
+    moved = 0
+    try:
+        while True:
+            n = archive_batch(year, batch_size or app.config['ARCHIVE_BATCH_SIZE'])
+            if not n: break
+            moved += n
+            if progress: progress(year, moved)
+        result = verify_archive_year(year)
+    except ArchiveVerificationError as e:
+        db.session.rollback()
+        state = db.session.get(ArchiveYear, year); state.status, state.error = 'failed', str(e)[:500]; db.session.commit()
+        raise
+    state.status, state.finished_at = 'verified', datetime.utcnow(); db.session.commit()
+    return moved, result
+
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_HEADER = ['日期', '收支類型', '主分類', '細項', '金額', '消費情緒', '備註']
+TYPE_LABELS = {'expense': '支出', 'income': '收入'}
+MOOD_LABELS = {'happy': '😊 值得', 'neutral': '😐 需要', 'regret': '😫 後悔'}
+
+def export_row(t):
+    return [t.date.strftime('%Y-%m-%d'), TYPE_LABELS['expense' if t.type == 'expense' else 'income'], t.main_category, t.item_name, t.amount, MOOD_LABELS.get(t.mood, MOOD_LABELS['neutral']), t.note]
+
+def iter_csv(rows):
+    # 每 EXPORT_CHUNK_SIZE 列輸出一次，緩衝區大小固定
+    buf = io.StringIO(); writer = csv.writer(buf)
+    buf.write(u'\ufeff'); writer.writerow(EXPORT_HEADER)
+    for i, t in enumerate(rows, 1):
+        writer.writerow(export_row(t))
+        if i % EXPORT_CHUNK_SIZE == 0: yield buf.getvalue(); buf.seek(0); buf.truncate()
+    yield buf.getvalue()
+
+def gzip_stream(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31) # wbits=31 -> gzip 格式
+    for chunk in chunks:
+        data = z.compress(chunk.encode('utf-8'))
+        if data: yield data
+    yield z.flush()
+
+IMPORT_BATCH_SIZE = 5000
+IMPORT_MAX_ERRORS = 100
+TYPE_FROM_LABEL = {**{v: k for k, v in TYPE_LABELS.items()}, 'expense': 'expense', 'income': 'income'}
+MOOD_FROM_LABEL = {**{v: k for k, v in MOOD_LABELS.items()}, 'happy': 'happy', 'neutral': 'neutral', 'regret': 'regret', '': 'neutral'}
+
+def parse_import_row(row):
+    # 匯出格式的一列 -> (dict, None) 或 (None, 錯誤原因)
+    if len(row) < 6: return None, '欄位數不足'
+    d_str, t_label, cat, item, amount_str, mood_label = (v.strip() for v in row[:6])
+    note = row[6] if len(row) > 6 else ''
+    try: t_date = datetime.strptime(d_str, '%Y-%m-%d').date()
+    except ValueError: return None, f'日期格式錯誤「{d_str}」'
+    if t_label not in TYPE_FROM_LABEL: return None, f'未知的收支類型「{t_label}」'
+    try: amount = int(amount_str)
+    except ValueError: return None, f'金額格式錯誤「{amount_str}」'
+    if not cat or len(cat) > 50: return None, '主分類為空或過長'
+    if not item or len(item) > 50: return None, '細項為空或過長'
+    if len(note) > 200: return None, '備註過長'
+    if mood_label not in MOOD_FROM_LABEL: return None, f'未知的消費情緒「{mood_label}」'
+    return {'date': t_date, 'type': TYPE_FROM_LABEL[t_label], 'main_category': cat, 'item_name': item, 'amount': amount, 'mood': MOOD_FROM_LABEL[mood_label], 'note': note}, None
+
+def bulk_insert_transactions(rows):
+    conn = db.session.connection()
+    if conn.dialect.name == 'postgresql':
+        cols = ['user_id', 'date', 'amount', 'type', 'main_category', 'item_name', 'note', 'mood', 'row_version']
+        buf = io.StringIO(); writer = csv.writer(buf)
+        for r in rows: writer.writerow([r[c] for c in cols])
+        buf.seek(0)
+        with conn.connection.cursor() as cur: cur.copy_expert(f'COPY "transaction" ({", ".join(cols)}) FROM STDIN WITH (FORMAT csv)', buf)
+    else: conn.execute(Transaction.__table__.insert(), rows)
+
+def import_transactions(user_id, stream, version=0):
+    # 邊讀邊驗證，每 IMPORT_BATCH_SIZE 筆批次寫入；彙總表在最後一次更新
+    reader = csv.reader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    header = next(reader, None)
+    if header is None or [h.strip() for h in header[:len(EXPORT_HEADER)]] != EXPORT_HEADER: return 0, [(1, '標題列與匯出格式不符')]
+    imported, errors, batch = 0, [], []
+    balance_delta = {'income': [0, 0], 'expense': [0, 0]}
+    months = set()
+    for row in reader:
+        if not any(v.strip() for v in row): continue
+        data, err = parse_import_row(row)
+        if err:
+            if len(errors) < IMPORT_MAX_ERRORS: errors.append((reader.line_num, err))
+            continue
+        data['user_id'] = user_id; data['row_version'] = version; batch.append(data)
+        balance_delta[data['type']][0] += data['amount']; balance_delta[data['type']][1] += 1
+        months.add((data['date'].year, data['date'].month))
+        if len(batch) >= IMPORT_BATCH_SIZE: bulk_insert_transactions(batch); imported += len(batch); batch = []
+    if batch: bulk_insert_transactions(batch); imported += len(batch)
+    if imported:
+        if db.session.get(UserBalance, user_id) is None: rebuild_balance(user_id)
+        else:
+            for t_type, (amount, n) in balance_delta.items():
+                if n: record_balance(user_id, t_type, amount, n)
+        for m_year, m_month in sorted(months): rebuild_month_rollup(user_id, m_year, m_month)
+    return imported, errors
+
+ADDED_COLUMNS = [
+    ('user', 'data_version', 'INTEGER NOT NULL DEFAULT 0'),
+    ('transaction', 'row_version', 'INTEGER NOT NULL DEFAULT 0'),
+    ('budget', 'row_version', 'INTEGER NOT NULL DEFAULT 0'),
+    ('subscription', 'row_version', 'INTEGER NOT NULL DEFAULT 0'),
+    ('user', 'primary_until', 'TIMESTAMP'),
+]
+
+def record_tombstone(user_id, kind, object_id, version):
+    db.session.add(Tombstone(user_id=user_id, kind=kind, object_id=object_id, row_version=version))
+
+def transaction_json(t):
+    return {"id": t.id, "date": t.date.strftime('%Y-%m-%d'), "type": t.type, "main_category": t.main_category, "item_name": t.item_name,
+            "amount": t.amount, "mood": t.mood, "note": t.note}
+
+def is_json_int(v): return isinstance(v, int) and not isinstance(v, bool) # JSON 的 true/false 在 Python 也是 int
+
+def parse_transaction_json(d):
+    # 同步 API 的交易欄位驗證 -> (dict, None) 或 (None, 錯誤原因)
+    if not isinstance(d, dict): return None, '格式錯誤'
+    try: t_date = datetime.strptime(str(d.get('date', '')), '%Y-%m-%d').date()
+    except ValueError: return None, '日期格式錯誤'
+    if d.get('type') not in ('income', 'expense'): return None, '未知的收支類型'
+    if not is_json_int(d.get('amount')): return None, '金額須為整數'
+    cat, item, note = d.get('main_category'), d.get('item_name'), d.get('note') or ''
+    if not isinstance(cat, str) or not cat or len(cat) > 50: return None, '主分類為空或過長'
+    if not isinstance(item, str) or not item or len(item) > 50: return None, '細項為空或過長'
+    if not isinstance(note, str) or len(note) > 200: return None, '備註過長'
+    mood = d.get('mood') or 'neutral'
+    if not isinstance(mood, str) or mood not in MOOD_LABELS: return None, '未知的消費情緒'
+    return {'date': t_date, 'type': d['type'], 'main_category': cat, 'item_name': item, 'amount': d['amount'], 'mood': mood, 'note': note}, None
+
+_achievement_catalog = {}
+
+def get_achievement_catalog():
+    # 成就清單幾乎不會變動，每個 worker 只載入一次
+    global _achievement_catalog
+    if not _achievement_catalog:
+        _achievement_catalog = {a.name: {"id": a.id, "name": a.name, "desc": a.description, "icon": a.icon} for a in Achievement.query.order_by(Achievement.id)}
+    return _achievement_catalog
+
+DEFAULT_ACHIEVEMENTS = [
+    {"name": "記帳新手", "desc": "記下你的第一筆帳", "icon": "fa-baby"},
+    {"name": "省錢達人", "desc": "單筆支出小於 50 元", "icon": "fa-piggy-bank"},
+    {"name": "大戶人家", "desc": "單筆收入超過 5000 元", "icon": "fa-crown"},
+    {"name": "訂閱管理者", "desc": "新增一筆訂閱服務", "icon": "fa-calendar-check"},
+    {"name": "預算守門員", "desc": "設定你的第一個預算", "icon": "fa-shield-alt"}
+]
+
+def seed_achievements():
+    # 單一 INSERT ... ON CONFLICT (name) DO NOTHING，重複執行或多個程序同時執行都不會產生重複資料
+    rows = [dict(name=a['name'], description=a['desc'], icon=a['icon']) for a in DEFAULT_ACHIEVEMENTS]
+    dialect = db.session.connection().dialect.name
+    if dialect == 'postgresql': from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite': from sqlalchemy.dialects.sqlite import insert
+    else:
+        existing = {name for (name,) in db.session.query(Achievement.name)}
+        rows = [r for r in rows if r['name'] not in existing]
+        if rows: db.session.execute(Achievement.__table__.insert(), rows)
+        _achievement_catalog.clear(); return len(rows)
+    inserted = db.session.execute(insert(Achievement).values(rows).on_conflict_do_nothing(index_elements=['name'])).rowcount
+    _achievement_catalog.clear()
+    return inserted
+
+# --- 資料庫版本遷移 (flask db-init / flask db-upgrade) ---
+# import 時不做任何 DDL/DML；部署時先執行 flask db-upgrade 再啟動 gunicorn
+def add_missing_columns():
+    # create_all 不會替既有資料表補欄位
+    insp = inspect(db.engine)
+    for table, column, ddl in ADDED_COLUMNS:
+        if column not in {c['name'] for c in insp.get_columns(table)}:
+            with db.engine.begin() as conn: conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl}'))
+
+def unique_achievement_names():
+    # 舊版每個 worker 啟動時各自 init，可能寫入同名成就；保留最小 id 後再建唯一索引
+    keep = dict(db.session.query(Achievement.name, func.min(Achievement.id)).group_by(Achievement.name).all())
+    for a_id, name in db.session.query(Achievement.id, Achievement.name).filter(Achievement.id.notin_(keep.values())).all():
+        UserAchievement.query.filter_by(achievement_id=a_id).update({UserAchievement.achievement_id: keep[name]}, synchronize_session=False)
+        Achievement.query.filter_by(id=a_id).delete(synchronize_session=False)
+    db.session.commit()
+    for ix in Achievement.__table__.indexes: ix.create(db.engine, checkfirst=True)
+
+def create_missing_indexes():
+    for table in db.metadata.sorted_tables:
+        for ix in table.indexes: ix.create(db.engine, checkfirst=True)
+
+def create_archive_tables():
+    for model in (TransactionArchive, YearlySummary, ArchiveYear): model.__table__.create(db.engine, checkfirst=True)
+
+def sync_keyset_indexes():
+    # 同名索引補上 id 欄位：先刪除舊定義再依模型重建
+    for table, name in ((Transaction.__table__, 'ix_transaction_user_version'), (TransactionArchive.__table__, 'ix_transaction_archive_user_version')):
+        ix = next(i for i in table.indexes if i.name == name)
+        with db.engine.begin() as conn: conn.execute(text(f'DROP INDEX IF EXISTS {name}')); ix.create(conn)
+
+def monotonic_transaction_ids():
+    # 舊的 SQLite 資料表沒有 AUTOINCREMENT：依模型重建並搬回資料，序號接在熱資料、封存資料與已刪除 (tombstone) 的最大 id 之後
+    if db.engine.dialect.name != 'sqlite': return
+    cols = ', '.join(TX_COLUMNS)
+    with db.engine.begin() as conn:
+        ddl = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'transaction'")).scalar()
+        if 'AUTOINCREMENT' in ddl.upper(): return
+        for ix in Transaction.__table__.indexes: conn.execute(text(f'DROP INDEX IF EXISTS {ix.name}'))
+        conn.execute(text('ALTER TABLE "transaction" RENAME TO transaction_old'))
+        Transaction.__table__.create(conn)
+        conn.execute(text(f'INSERT INTO "transaction" ({cols}) SELECT {cols} FROM transaction_old'))
+        conn.execute(text('DROP TABLE transaction_old'))
+        top = conn.execute(text('SELECT MAX(id) FROM (SELECT MAX(id) AS id FROM "transaction" UNION ALL SELECT MAX(id) FROM transaction_archive '
+                                "UNION ALL SELECT MAX(object_id) FROM tombstone WHERE kind = 'transaction')")).scalar() or 0
+        conn.execute(text("DELETE FROM sqlite_sequence WHERE name = 'transaction'"))
+        conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('transaction', :top)"), {'top': top})
+
+MIGRATIONS = [
+    (1, 'create tables', db.create_all),
+    (2, 'data_version / row_version columns', add_missing_columns),
+    (3, 'unique achievement names', unique_achievement_names),
+    (4, 'query indexes', create_missing_indexes),
+    (5, 'transaction archive', create_archive_tables),
+    (6, 'sync keyset indexes', sync_keyset_indexes),
+    (7, 'user.primary_until column', add_missing_columns),
+    (8, 'monotonic transaction ids', monotonic_transaction_ids),
+]
+
+def applied_migrations():
+    if not inspect(db.engine).has_table(SchemaVersion.__tablename__): return set()
+    return {v for (v,) in db.session.query(SchemaVersion.version)}
+
+def upgrade_database():
+    # 依序套用尚未執行的遷移，每一版各自 commit；最後補上預設資料
+    SchemaVersion.__table__.create(db.engine, checkfirst=True)
+    done, applied = applied_migrations(), []
+    for version, name, migrate in MIGRATIONS:
+        if version in done: continue
+        migrate()
+        db.session.add(SchemaVersion(version=version, name=name)); db.session.commit()
+        applied.append(version)
+    seeded = seed_achievements(); db.session.commit()
+    return applied, seeded
+
+def init_database():
+    # 全新資料庫直接依目前模型建立並標記為最新版本；已有資料表時等同 upgrade
+    if inspect(db.engine).has_table(User.__tablename__): return upgrade_database()
     db.create_all()
-    init_achievements()
-
-def check_achievements(user, transaction=None, subscription=None, budget=None):
-    earned = [ua.achievement_id for ua in user.achievements]
-    if transaction and len(user.transactions) == 1: grant_achievement(user, "記帳新手", earned)
-    if transaction and transaction.type == 'expense' and transaction.amount < 50: grant_achievement(user, "省錢達人", earned)
-    if transaction and transaction.type == 'income' and transaction.amount > 5000: grant_achievement(user, "大戶人家", earned)
-    if subscription: grant_achievement(user, "訂閱管理者", earned)
-    if budget: grant_achievement(user, "預算守門員", earned)
-
-def grant_achievement(user, ach_name, earned_ids):
-    ach = Achievement.query.filter_by(name=ach_name).first()
-    if ach and ach.id not in earned_ids:
-        db.session.add(UserAchievement(user_id=user.id, achievement_id=ach.id))
-        db.session.commit()
-        flash(f"🏆 解鎖成就：{ach_name}！")
+    db.session.add_all([SchemaVersion(version=version, name=name) for version, name, _ in MIGRATIONS])
+    seeded = seed_achievements(); db.session.commit()
+    return [version for version, _, _ in MIGRATIONS], seeded
+
+def dispose_engines_after_fork():
+    # gunicorn --preload：子程序不可沿用 master 建立的連線
+    with app.app_context():
+        for engine in db.engines.values(): engine.dispose(close=False)
+
+if hasattr(os, 'register_at_fork'): os.register_at_fork(after_in_child=dispose_engines_after_fork)
+
+def check_achievements(user, transaction=None, subscription=None, budget=None, first_transaction=None):
+    # 只把 UserAchievement 加進 session，由呼叫端一起 commit
+    candidates = []
+    if first_transaction or (transaction and first_transaction is None): candidates.append("記帳新手") # 呼叫端已知是否為第一筆時不再查詢
+    if transaction and transaction.type == 'expense' and transaction.amount < 50: candidates.append("省錢達人")
+    if transaction and transaction.type == 'income' and transaction.amount > 5000: candidates.append("大戶人家")
+    if subscription: candidates.append("訂閱管理者")
+    if budget: candidates.append("預算守門員")
+    catalog = get_achievement_catalog()
+    ids = {catalog[name]['id']: name for name in candidates if name in catalog}
+    if not ids: return
+    earned = {a_id for (a_id,) in db.session.query(UserAchievement.achievement_id).filter(UserAchievement.user_id == user.id, UserAchievement.achievement_id.in_(ids))}
+    for a_id, name in ids.items():
+        if a_id in earned: continue
+        if name == "記帳新手" and first_transaction is None:
+            others = db.session.query(AllTransaction.id).filter(AllTransaction.user_id == user.id, AllTransaction.id != transaction.id)
+            if db.session.query(others.exists()).scalar(): continue
+        grant_achievement(user, a_id, name)
+
+def grant_achievement(user, ach_id, ach_name):
+    db.session.add(UserAchievement(user_id=user.id, achievement_id=ach_id))
+    if has_request_context(): flash(f"🏆 解鎖成就：{ach_name}！") # 背景工作中沒有 session 可顯示
 
 # --- 路由 ---
 
 @app.route('/create_ecpay_order', methods=['POST'])
 @login_required
 def create_ecpay_order():
-    order_id = f"FinanceApp{int(time.time())}" 
     order_time = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
-    amount = 100
-    new_order = Order(trade_no=order_id, amount=amount, user_id=current_user.id, status="Pending")
-    db.session.add(new_order); db.session.commit()
+    amount = PREMIUM_PRICE
+    for attempt in range(3):
+        order_id = new_trade_no()
+        db.session.add(Order(trade_no=order_id, amount=amount, user_id=current_user.id, status="Pending"))
+        try: db.session.commit(); break
+        except IntegrityError:
+            db.session.rollback()
+            if attempt == 2: raise
     params = {
         'MerchantID': ECPAY_MERCHANT_ID, 'MerchantTradeNo': order_id, 'MerchantTradeDate': order_time,
         'PaymentType': 'aio', 'TotalAmount': str(amount), 'TradeDesc': 'Upgrade to Premium',
-        'ItemName': '記帳管家-付費會員', 'ReturnURL': 'https://www.example.com', 
+        'ItemName': '記帳管家-付費會員', 'ReturnURL': ECPAY_RETURN_URL or url_for('ecpay_notify', _external=True),
         'ClientBackURL': url_for('ecpay_return', order_id=order_id, _external=True), 'ChoosePayment': 'ALL', 'EncryptType': '1',
     }
     params['CheckMacValue'] = get_mac_value(params)
     form_html = f'''<form id="ecpay_form" action="{ECPAY_ACTION_URL}" method="POST">{''.join([f'<input type="hidden" name="{k}" value="{v}">' for k, v in params.items()])}</form><script>document.getElementById("ecpay_form").submit();</script>'''
     return form_html
 
+@app.route('/ecpay/notify', methods=['POST'])
+def ecpay_notify():
+    # 綠界伺服器端付款結果通知 (ReturnURL)；必須回傳 1|OK，否則綠界會重送
+    params, valid = verify_ecpay_callback(request.form)
+    if not valid:
+        app.logger.warning('ecpay notify rejected: bad CheckMacValue trade_no=%s', params.get('MerchantTradeNo'))
+        return '0|CheckMacValue Error', 400
+    trade_no = params.get('MerchantTradeNo', '')
+    if params.get('RtnCode') != '1':
+        app.logger.info('ecpay notify trade_no=%s RtnCode=%s %s', trade_no, params.get('RtnCode'), params.get('RtnMsg'))
+        return '1|OK'
+    try: amount = int(params.get('TradeAmt', ''))
+    except ValueError: return '0|TradeAmt Error', 400
+    if not apply_ecpay_payment(trade_no, amount):
+        app.logger.warning('ecpay notify for unknown order or amount mismatch trade_no=%s amount=%s', trade_no, amount)
+        return '0|Order Error', 400
+    return '1|OK'
+
 @app.route('/ecpay_return')
 @login_required
 def ecpay_return():
-    order_id = request.args.get('order_id')
-    order = Order.query.filter_by(trade_no=order_id).first()
-    if order and order.user_id == current_user.id:
-        order.status = "Paid"
-        current_user.is_premium = True
-        db.session.commit()
-        flash('🎉 付款成功！感謝您的支持。')
-    else: flash('⚠️ 訂單驗證失敗。')
+    # 使用者導回頁面只讀取狀態，付款結果以伺服器端通知為準
+    order = Order.query.filter_by(trade_no=request.args.get('order_id'), user_id=current_user.id).first()
+    if not order: flash('⚠️ 訂單驗證失敗。')
+    elif order.status == 'Paid': flash('🎉 付款成功！感謝您的支持。')
+    else: flash('⏳ 付款確認中，請稍後重新整理。')
     return redirect(url_for('settings'))
 
 @app.route('/cancel_premium')
 @login_required
 def cancel_premium():
-    if current_user.is_premium: current_user.is_premium = False; db.session.commit(); flash('⚠️ 已取消付費會員資格。')
+    if current_user.is_premium: current_user.is_premium = False; touch_user(current_user.id); db.session.commit(); flash('⚠️ 已取消付費會員資格。')
     return redirect(url_for('settings'))
 
 @app.route('/restore_purchase')
 @login_required
 def restore_purchase():
-    paid_order = Order.query.filter_by(user_id=current_user.id, status="Paid").first()
-    if paid_order: current_user.is_premium = True; db.session.commit(); flash('♻️ 恢復成功！')
+    paid_order = db.session.query(Order.id).filter_by(user_id=current_user.id, status="Paid").first() # ix_order_user_status
+    if paid_order: current_user.is_premium = True; touch_user(current_user.id); db.session.commit(); flash('♻️ 恢復成功！')
     else: flash('❌ 查無付款紀錄。')
     return redirect(url_for('settings'))
 
@@ -251,6 +1137,8 @@ def logout(): logout_user(); return redirect(url_for('login'))
 
 @app.route('/', methods=['GET', 'POST'])
 @login_required
+@replica_reads
+@user_context(max_queries={'GET': 11, 'POST': 17}) # GET 含新帳號第一次開首頁時重建 UserBalance (見 tests/test_query_budgets.py)，以及讀副本時 cached_page 核對 data_version
 def index():
     if request.method == 'POST':
         amount = int(request.form['amount'])
@@ -261,99 +1149,143 @@ def index():
         mood = request.form.get('mood', 'neutral')
         date_str = request.form.get('date')
         t_date = datetime.strptime(date_str, '%Y-%m-%d') if date_str else datetime.now()
-        new_trans = Transaction(amount=amount, type=t_type, main_category=main_cat, item_name=item, note=note, mood=mood, date=t_date, owner=current_user)
-        db.session.add(new_trans); db.session.commit()
+        version = touch_user(current_user.id)
+        new_trans = Transaction(amount=amount, type=t_type, main_category=main_cat, item_name=item, note=note, mood=mood, date=t_date, owner=current_user, row_version=version)
+        db.session.add(new_trans); record_transaction(new_trans)
         check_achievements(current_user, transaction=new_trans)
+        db.session.commit()
         return redirect(url_for('index'))
 
-    current_month = request.args.get('month', datetime.now().strftime('%Y-%m'))
-    try: m_year, m_month = map(int, current_month.split('-'))
-    except: today = datetime.now(); m_year, m_month = today.year, today.month; current_month = today.strftime('%Y-%m')
+    m_year, m_month, current_month = parse_month(request.args.get('month', datetime.now().strftime('%Y-%m')))
+    start, end = month_range(m_year, m_month)
+    cursor = request.args.get('before')
+
+    def render():
+        transactions, next_cursor = ledger_page(current_user.id, start, end, cursor)
+        T = AllTransaction
+        month_rows = db.session.query(T.date, T.type, func.sum(T.amount)).filter(T.user_id == current_user.id, T.date >= start, T.date < end).group_by(T.date, T.type).all()
+        day_totals = {}
+        month_income = month_expense = 0
+        for d, t_type, total in month_rows:
+            if t_type == 'income': month_income += total; day_totals[d] = day_totals.get(d, 0) + total
+            else: month_expense += total; day_totals[d] = day_totals.get(d, 0) - total
+        balance = get_balance(current_user.id)
+        net_worth = balance.income - balance.expense
+        fire_progress = 0
+        if current_user.fire_target > 0: fire_progress = min(100, int((net_worth / current_user.fire_target) * 100))
 
-    transactions = Transaction.query.filter(Transaction.user_id == current_user.id, func.extract('year', Transaction.date) == m_year, func.extract('month', Transaction.date) == m_month).order_by(Transaction.date.desc()).all()
-    all_income = db.session.query(func.sum(Transaction.amount)).filter_by(user_id=current_user.id, type='income').scalar() or 0
-    all_expense = db.session.query(func.sum(Transaction.amount)).filter_by(user_id=current_user.id, type='expense').scalar() or 0
-    net_worth = all_income - all_expense
-    fire_progress = 0
-    if current_user.fire_target > 0: fire_progress = min(100, int((net_worth / current_user.fire_target) * 100))
+        return render_template('index.html', transactions=transactions, user=current_user, current_month=current_month, net_worth=net_worth, fire_progress=fire_progress,
+                               month_income=month_income, month_expense=month_expense, day_totals=day_totals, cursor=cursor, next_cursor=next_cursor)
 
-    return render_template('index.html', transactions=transactions, user=current_user, current_month=current_month, net_worth=net_worth, fire_progress=fire_progress)
+    return cached_page(render, current_month, cursor)
+
+@app.route('/api/ledger')
+@login_required
+@replica_reads
+@user_context(max_queries=3)
+def api_ledger():
+    m_year, m_month, current_month = parse_month(request.args.get('month', datetime.now().strftime('%Y-%m')))
+    start, end = month_range(m_year, m_month)
+    try: limit = max(1, min(LEDGER_MAX_PAGE_SIZE, int(request.args.get('limit', LEDGER_PAGE_SIZE))))
+    except ValueError: limit = LEDGER_PAGE_SIZE
+    rows, next_cursor = ledger_page(current_user.id, start, end, request.args.get('before'), limit)
+    return jsonify(month=current_month, items=[transaction_json(t) for t in rows], next_cursor=next_cursor)
 
 @app.route('/analysis')
 @login_required
+@replica_reads
+@user_context(max_queries=9)
 def analysis():
-    current_month = request.args.get('month', datetime.now().strftime('%Y-%m'))
-    try: m_year, m_month = map(int, current_month.split('-'))
-    except: today = datetime.now(); m_year, m_month = today.year, today.month; current_month = today.strftime('%Y-%m')
-
-    monthly_data = Transaction.query.filter(Transaction.user_id == current_user.id, func.extract('year', Transaction.date) == m_year, func.extract('month', Transaction.date) == m_month).order_by(Transaction.amount.desc()).all()
-    expenses = [t for t in monthly_data if t.type == 'expense']
-    incomes = [t for t in monthly_data if t.type == 'income']
-    total_exp = sum(t.amount for t in expenses)
-    total_inc = sum(t.amount for t in incomes)
-
-    def group_data(data_list):
-        grouped = {}
-        for t in data_list:
-            if t.main_category not in grouped: grouped[t.main_category] = {'total': 0, 'details': []}
-            grouped[t.main_category]['total'] += t.amount
-            grouped[t.main_category]['details'].append(t)
-        return grouped
-
-    exp_grouped = group_data(expenses)
-    inc_grouped = group_data(incomes)
-
-    user_budgets = Budget.query.filter_by(user_id=current_user.id).all()
-    budget_analysis = []
-    
-    # 情緒消費
-    regret_amount = sum(t.amount for t in expenses if t.mood == 'regret')
-    regret_percent = 0
-    if total_exp > 0: regret_percent = int((regret_amount / total_exp) * 100)
-
-    if current_user.is_premium:
-        for b in user_budgets:
-            spent = exp_grouped.get(b.category, {'total': 0})['total']
-            if b.amount > 0: percent = min(100, int((spent / b.amount) * 100))
-            else: percent = 100 if spent > 0 else 0
-            status = "danger" if percent >= 100 else ("warning" if percent >= 80 else "success")
-            budget_analysis.append({"category": b.category, "limit": b.amount, "spent": spent, "percent": percent, "status": status})
-
-    ai_advice = ""
-    if current_user.is_premium:
-        top_cat = max(exp_grouped, key=lambda k: exp_grouped[k]['total']) if exp_grouped else None
-        if regret_percent > 20: ai_advice = f"⚠️ 警報！本月有 {regret_percent}% 的支出是「後悔消費」，建議在下次付款前多想 3 秒鐘。"
-        elif total_inc > 0:
-            rate = (total_inc - total_exp) / total_inc
-            if rate < 0: ai_advice = f"本月已透支！最大支出為「{top_cat}」。"
-            elif rate < 0.2: ai_advice = "儲蓄率偏低，建議設定預算來控制花費。"
-            else: ai_advice = "儲蓄率健康！繼續保持快樂理財。"
-        elif total_exp > 0: ai_advice = "本月尚無收入，但已有支出。"
-        else: ai_advice = "目前沒有資料。"
-    else: ai_advice = "🔒 [付費限定] 升級會員以解鎖 AI 財務診斷、情緒消費分析與預算監控。"
-
-    return render_template('analysis.html', 
-                           exp_grouped=exp_grouped, inc_grouped=inc_grouped,
-                           exp_labels=list(exp_grouped.keys()), exp_values=[d['total'] for d in exp_grouped.values()],
-                           inc_labels=list(inc_grouped.keys()), inc_values=[d['total'] for d in inc_grouped.values()],
-                           total_expense=total_exp, total_income=total_inc,
-                           current_month=current_month, user=current_user, ai_advice=ai_advice,
-                           budget_analysis=budget_analysis, regret_amount=regret_amount, regret_percent=regret_percent)
+    m_year, m_month, current_month = parse_month(request.args.get('month', datetime.now().strftime('%Y-%m')))
+    start, end = month_range(m_year, m_month)
+
+    def render():
+        year_month = current_month
+        rollups = MonthlyRollup.query.filter_by(user_id=current_user.id, year_month=year_month).all()
+        T = AllTransaction
+        if not rollups: read_primary()
+        if not rollups and db.session.query(db.session.query(T.id).filter(T.user_id == current_user.id, T.date >= start, T.date < end).exists()).scalar():
+            rollups = rebuild_month_rollup(current_user.id, m_year, m_month); db.session.commit()
+
+        def group_data(t_type):
+            grouped = {}
+            for r in rollups:
+                if r.type != t_type or r.count <= 0: continue
+                bucket = grouped.setdefault(r.main_category, {'total': 0, 'count': 0})
+                bucket['total'] += r.total; bucket['count'] += r.count
+            return dict(sorted(grouped.items(), key=lambda kv: kv[1]['total'], reverse=True))
+
+        exp_grouped = group_data('expense')
+        inc_grouped = group_data('income')
+        total_exp = sum(d['total'] for d in exp_grouped.values())
+        total_inc = sum(d['total'] for d in inc_grouped.values())
+
+        budget_analysis = []
+
+        # 情緒消費
+        regret_amount = sum(r.total for r in rollups if r.type == 'expense' and r.mood == 'regret')
+        regret_percent = 0
+        if total_exp > 0: regret_percent = int((regret_amount / total_exp) * 100)
+
+        if current_user.is_premium:
+            for b in Budget.query.filter_by(user_id=current_user.id).all():
+                spent = exp_grouped.get(b.category, {'total': 0})['total']
+                if b.amount > 0: percent = min(100, int((spent / b.amount) * 100))
+                else: percent = 100 if spent > 0 else 0
+                status = "danger" if percent >= 100 else ("warning" if percent >= 80 else "success")
+                budget_analysis.append({"category": b.category, "limit": b.amount, "spent": spent, "percent": percent, "status": status})
+
+        ai_advice = ""
+        if current_user.is_premium:
+            top_cat = max(exp_grouped, key=lambda k: exp_grouped[k]['total']) if exp_grouped else None
+            if regret_percent > 20: ai_advice = f"⚠️ 警報！本月有 {regret_percent}% 的支出是「後悔消費」，建議在下次付款前多想 3 秒鐘。"
+            elif total_inc > 0:
+                rate = (total_inc - total_exp) / total_inc
+                if rate < 0: ai_advice = f"本月已透支！最大支出為「{top_cat}」。"
+                elif rate < 0.2: ai_advice = "儲蓄率偏低，建議設定預算來控制花費。"
+                else: ai_advice = "儲蓄率健康！繼續保持快樂理財。"
+            elif total_exp > 0: ai_advice = "本月尚無收入，但已有支出。"
+            else: ai_advice = "目前沒有資料。"
+        else: ai_advice = "🔒 [付費限定] 升級會員以解鎖 AI 財務診斷、情緒消費分析與預算監控。"
+
+        return render_template('analysis.html', 
+                               exp_grouped=exp_grouped, inc_grouped=inc_grouped,
+                               exp_labels=list(exp_grouped.keys()), exp_values=[d['total'] for d in exp_grouped.values()],
+                               inc_labels=list(inc_grouped.keys()), inc_values=[d['total'] for d in inc_grouped.values()],
+                               total_expense=total_exp, total_income=total_inc,
+                               current_month=current_month, user=current_user, ai_advice=ai_advice,
+                               budget_analysis=budget_analysis, regret_amount=regret_amount, regret_percent=regret_percent)
+
+    return cached_page(render, current_month)
+
+@app.route('/analysis/details')
+@login_required
+@replica_reads
+@user_context(max_queries=3)
+def analysis_details():
+    # 分類展開時才載入該分類的明細
+    m_year, m_month, current_month = parse_month(request.args.get('month', datetime.now().strftime('%Y-%m')))
+    start, end = month_range(m_year, m_month)
+    t_type = 'income' if request.args.get('type') == 'income' else 'expense'
+    T = AllTransaction
+    rows = db.session.query(T.id, T.item_name, T.amount, T.mood).filter(T.user_id == current_user.id, T.type == t_type, T.date >= start, T.date < end,
+                                                                       T.main_category == request.args.get('category', '')).order_by(T.amount.desc()).limit(ANALYSIS_DETAIL_LIMIT).all()
+    return jsonify(items=[{"id": t.id, "item_name": t.item_name, "amount": t.amount, "mood": t.mood} for t in rows])
 
 @app.route('/add_subscription', methods=['POST'])
 @login_required
 def add_subscription():
     if not current_user.is_premium: flash('🔒 請先升級。'); return redirect(url_for('settings'))
     name = request.form['name']; amount = int(request.form['amount'])
-    sub = Subscription(name=name, amount=amount, owner=current_user)
-    db.session.add(sub); db.session.commit(); check_achievements(current_user, subscription=sub)
+    sub = Subscription(name=name, amount=amount, owner=current_user, row_version=touch_user(current_user.id))
+    db.session.add(sub); check_achievements(current_user, subscription=sub); db.session.commit()
     return redirect(url_for('settings'))
 
 @app.route('/delete_subscription/<int:id>')
 @login_required
 def delete_subscription(id):
     sub = Subscription.query.get_or_404(id)
-    if sub.user_id == current_user.id: db.session.delete(sub); db.session.commit()
+    if sub.user_id == current_user.id: db.session.delete(sub); record_tombstone(current_user.id, 'subscription', sub.id, touch_user(current_user.id)); db.session.commit()
     return redirect(url_for('settings'))
 
 @app.route('/update_budget', methods=['POST'])
@@ -361,16 +1293,17 @@ def delete_subscription(id):
 def update_budget():
     if not current_user.is_premium: flash('🔒 請先升級。'); return redirect(url_for('settings'))
     categories = ["餐飲", "交通", "娛樂", "購物", "房租", "其他"]
+    version = touch_user(current_user.id)
     for cat in categories:
         amount_str = request.form.get(f'budget_{cat}')
         if amount_str and amount_str.strip():
             try:
                 amount = int(amount_str)
                 existing = Budget.query.filter_by(user_id=current_user.id, category=cat).first()
-                if existing: existing.amount = amount
-                else: db.session.add(Budget(category=cat, amount=amount, owner=current_user))
+                if existing: existing.amount = amount; existing.row_version = version
+                else: db.session.add(Budget(category=cat, amount=amount, owner=current_user, row_version=version))
             except ValueError: pass
-    db.session.commit(); check_achievements(current_user, budget=True); flash('預算設定已更新！')
+    check_achievements(current_user, budget=True); db.session.commit(); flash('預算設定已更新！')
     return redirect(url_for('settings'))
 
 @app.route('/update_profile', methods=['POST'])
@@ -379,7 +1312,7 @@ def update_profile():
     current_user.display_name = request.form['display_name']; current_user.bio = request.form['bio']
     try: current_user.fire_target = int(request.form['fire_target'])
     except ValueError: pass
-    db.session.commit(); flash('設定已更新！')
+    touch_user(current_user.id); db.session.commit(); flash('設定已更新！')
     return redirect(url_for('settings'))
 
 @app.route('/change_password', methods=['POST'])
@@ -398,41 +1331,674 @@ def submit_feedback():
     if message: fb = Feedback(user_id=current_user.id, message=message); db.session.add(fb); db.session.commit(); flash('感謝您的回饋！')
     return redirect(url_for('settings'))
 
+def parse_export_params(args):
+    # -> (params, None) 或 (None, 錯誤訊息)
+    try:
+        d_from = datetime.strptime(args['from'], '%Y-%m-%d').date() if args.get('from') else None
+        d_to = datetime.strptime(args['to'], '%Y-%m-%d').date() if args.get('to') else None
+    except (ValueError, TypeError): return None, '⚠️ 日期格式錯誤 (YYYY-MM-DD)。'
+    return {'from': d_from and d_from.isoformat(), 'to': d_to and d_to.isoformat(), 'gzip': str(args.get('gzip')) in ('1', 'True', 'true')}, None
+
+def export_rows(user_id, d_from=None, d_to=None):
+    # 只取需要的欄位，以 server-side cursor 分批讀取，不把整段歷史載入記憶體；包含已封存的年度
+    T = AllTransaction
+    q = db.session.query(T.date, T.type, T.main_category, T.item_name, T.amount, T.mood, T.note).filter(T.user_id == user_id)
+    if d_from: q = q.filter(T.date >= d_from)
+    if d_to: q = q.filter(T.date < d_to + timedelta(days=1))
+    return q.order_by(T.date.desc(), T.id.desc()).yield_per(EXPORT_CHUNK_SIZE)
+
 @app.route('/export_csv')
 @login_required
+@user_context(max_queries=4)
 def export_csv():
     if not current_user.is_premium: flash('🔒 請先升級。'); return redirect(url_for('settings'))
-    all_trans = Transaction.query.filter_by(user_id=current_user.id).order_by(Transaction.date.desc()).all()
-    output = io.StringIO(); output.write(u'\ufeff'); writer = csv.writer(output)
-    writer.writerow(['日期', '收支類型', '主分類', '細項', '金額', '消費情緒', '備註'])
-    for t in all_trans:
-        t_type_zh = "支出" if t.type == "expense" else "收入"
-        mood_zh = "😐 需要"
-        if t.mood == 'happy': mood_zh = "😊 值得"
-        elif t.mood == 'regret': mood_zh = "😫 後悔"
-        writer.writerow([t.date.strftime('%Y-%m-%d'), t_type_zh, t.main_category, t.item_name, t.amount, mood_zh, t.note])
-    return Response(output.getvalue(), mimetype="text/csv", headers={"Content-disposition": "attachment; filename=finance_report.csv"})
+    params, err = parse_export_params(request.args)
+    if err: flash(err); return redirect(url_for('settings'))
+    return job_accepted('export_csv', params, message='📤 匯出已排入背景處理，完成後可在「背景工作」下載。')
+
+@app.route('/import_csv', methods=['POST'])
+@login_required
+@user_context(max_queries=4)
+def import_csv():
+    if not current_user.is_premium: flash('🔒 請先升級。'); return redirect(url_for('settings'))
+    f = request.files.get('file')
+    if not f or not f.filename: flash('⚠️ 請選擇要匯入的 CSV 檔案。'); return redirect(url_for('settings'))
+    return job_accepted('import_csv', upload=f.stream, message='📥 檔案已上傳，匯入結果會顯示在「背景工作」。')
+
+# --- 背景工作 ---
+app.config.setdefault('JOB_WORKERS', int(os.environ.get('JOB_WORKERS', 2))) # web 程序內的背景執行緒數；0 表示只由 flask run-jobs 處理
+app.config.setdefault('JOB_STORAGE_DIR', os.environ.get('JOB_STORAGE_DIR', os.path.join(app.instance_path, 'jobs'))) # 上傳檔與結果檔，web 與 worker 需共用
+app.config.setdefault('JOB_MAX_ACTIVE_PER_USER', 3) # 每位使用者排隊中 + 執行中的上限
+app.config.setdefault('JOB_USER_CONCURRENCY', 1) # 每位使用者同時執行的上限
+app.config.setdefault('JOB_MAX_ATTEMPTS', 3)
+app.config.setdefault('JOB_RETRY_SECONDS', 30) # 第 n 次失敗後等待 JOB_RETRY_SECONDS * 2^(n-1) 秒再試
+app.config.setdefault('JOB_TIMEOUT_SECONDS', 1800) # running 超過此時間視為 worker 已中斷
+app.config.setdefault('JOB_RESULT_TTL_HOURS', 24)
+app.config.setdefault('JOB_POLL_SECONDS', 2)
+
+JOB_HANDLERS = {}
+JOB_KIND_LABELS = {'export_csv': '匯出報表', 'import_csv': '匯入紀錄', 'rebuild_aggregates': '重建統計'}
+JOB_STATUS_LABELS = {'queued': '排隊中', 'running': '處理中', 'done': '完成', 'failed': '失敗'}
+PREMIUM_JOB_KINDS = {'export_csv', 'import_csv'}
+API_JOB_KINDS = {'export_csv', 'rebuild_aggregates'} # 可由 POST /jobs 直接排入；匯入需透過 /import_csv 上傳
+
+class JobLimitExceeded(RuntimeError): pass
+
+def job_handler(kind):
+    def decorator(f): JOB_HANDLERS[kind] = f; return f
+    return decorator
+
+def job_path(job_id, suffix):
+    os.makedirs(app.config['JOB_STORAGE_DIR'], exist_ok=True)
+    return os.path.join(app.config['JOB_STORAGE_DIR'], f'job-{job_id}.{suffix}')
+
+def remove_job_files(job_id, suffixes=('in', 'out', 'tmp')):
+    for suffix in suffixes:
+        try: os.remove(job_path(job_id, suffix))
+        except FileNotFoundError: pass
+
+def enqueue_job(user_id, kind, params=None, upload=None):
+    # 以 DB 資料列作為佇列；上傳檔先寫入共用目錄再交給 worker
+    active = db.session.query(func.count(Job.id)).filter(Job.user_id == user_id, Job.status.in_(('queued', 'running'))).scalar()
+    if active >= app.config['JOB_MAX_ACTIVE_PER_USER']: raise JobLimitExceeded(user_id)
+    job = Job(user_id=user_id, kind=kind, params=json.dumps(params or {}))
+    db.session.add(job); db.session.flush()
+    if upload is not None:
+        with open(job_path(job.id, 'in'), 'wb') as f: shutil.copyfileobj(upload, f)
+    db.session.commit()
+    start_job_workers()
+    return job
+
+def job_json(job):
+    d = {"id": job.id, "kind": job.kind, "status": job.status, "attempts": job.attempts, "error": job.error,
+         "result": json.loads(job.result) if job.result else None, "status_url": url_for('job_status', job_id=job.id),
+         "created_at": job.created_at.isoformat() + 'Z', "finished_at": job.finished_at and job.finished_at.isoformat() + 'Z',
+         "expires_at": job.expires_at and job.expires_at.isoformat() + 'Z'}
+    if job.status == 'done' and job.result_name: d['download_url'] = url_for('job_download', job_id=job.id)
+    return d
+
+def job_accepted(kind, params=None, upload=None, message=None):
+    # 表單送出時導回設定頁；?format=json 時回傳 202 與工作狀態網址
+    wants_json = request.args.get('format') == 'json' or request.is_json
+    try: job = enqueue_job(current_user.id, kind, params, upload)
+    except JobLimitExceeded:
+        msg = f"⏳ 已有 {app.config['JOB_MAX_ACTIVE_PER_USER']} 個背景工作在處理中，請稍後再試。"
+        if wants_json: return jsonify(error=msg), 429
+        flash(msg); return redirect(url_for('settings'))
+    if wants_json: return jsonify(job_json(job)), 202, {'Location': url_for('job_status', job_id=job.id)}
+    flash(message); return redirect(url_for('settings'))
+
+def claim_job():
+    # 條件式更新搶下一筆工作，多個執行緒或程序同時搶時只有一個會成功
+    # 使用者的執行中數量也寫在 UPDATE 的 WHERE 內；Postgres 另外鎖住使用者列，同一位使用者的搶工作依序進行，後到的才看得到前一筆已 commit 的 running
+    now = datetime.utcnow()
+    limit = app.config['JOB_USER_CONCURRENCY']
+    busy = db.select(Job.user_id).where(Job.status == 'running').group_by(Job.user_id).having(func.count(Job.id) >= limit)
+    candidates = db.session.query(Job.id, Job.user_id).filter(Job.status == 'queued', Job.run_after <= now, Job.user_id.notin_(busy)).order_by(Job.run_after, Job.id).limit(5).all()
+    running = aliased(Job)
+    for job_id, user_id in candidates:
+        if db.session.connection().dialect.name == 'postgresql': db.session.execute(db.select(User.id).where(User.id == user_id).with_for_update())
+        running_count = db.select(func.count(running.id)).where(running.user_id == user_id, running.status == 'running').scalar_subquery()
+        claimed = db.session.execute(db.update(Job).where(Job.id == job_id, Job.status == 'queued', running_count < limit)
+                                     .values(status='running', locked_at=now, attempts=Job.attempts + 1)).rowcount
+        db.session.commit()
+        if claimed: return db.session.get(Job, job_id)
+    db.session.commit()
+    return None
+
+def finish_job(job_id, attempts, **values):
+    # 只有工作仍由這次嘗試持有時才寫入結果；逾時被 reap_jobs 重新排隊 (或已被別的 worker 再次搶走) 時回傳 0
+    return db.session.execute(db.update(Job).where(Job.id == job_id, Job.status == 'running', Job.attempts == attempts).values(**values)).rowcount
+
+def run_job(job):
+    # 處理函式不 commit；資料異動與工作狀態在同一個 DB transaction 內提交，重試或逾時後的舊執行緒都不會重複寫入
+    job_id, kind, attempts, t0 = job.id, job.kind, job.attempts, time.perf_counter()
+    try:
+        result = JOB_HANDLERS[kind](job, json.loads(job.params or '{}'))
+        values = dict(status='done', result=json.dumps(result or {}, ensure_ascii=False), error=None)
+        mark_primary_sticky(job.user_id) # 匯入可能跑很久，從實際 commit 起算讀主庫的時間
+    except Exception as e:
+        db.session.rollback()
+        app.logger.exception('job %s (%s) failed, attempt %s', job_id, kind, attempts)
+        values = dict(status='failed', error=f'{type(e).__name__}: {e}'[:500])
+        if attempts < app.config['JOB_MAX_ATTEMPTS']:
+            values.update(status='queued', run_after=datetime.utcnow() + timedelta(seconds=app.config['JOB_RETRY_SECONDS'] * 2 ** (attempts - 1)))
+    if values['status'] != 'queued':
+        finished = datetime.utcnow(); values.update(finished_at=finished, expires_at=finished + timedelta(hours=app.config['JOB_RESULT_TTL_HOURS']))
+    if not finish_job(job_id, attempts, **values):
+        db.session.rollback()
+        app.logger.warning('job %s (%s) attempt %s timed out and was reclaimed, discarding its changes', job_id, kind, attempts)
+        return None
+    db.session.commit()
+    if values['status'] != 'queued': remove_job_files(job_id, ('in', 'tmp'))
+    app.logger.info('job %s (%s) %s in %.1fs', job_id, kind, values['status'], time.perf_counter() - t0)
+    return db.session.get(Job, job_id)
+
+def reap_jobs():
+    # 逾時的 running 重新排隊或標記失敗；過期的工作連同檔案刪除
+    now = datetime.utcnow()
+    stale = and_(Job.status == 'running', Job.locked_at < now - timedelta(seconds=app.config['JOB_TIMEOUT_SECONDS']))
+    db.session.execute(db.update(Job).where(stale, Job.attempts < app.config['JOB_MAX_ATTEMPTS']).values(status='queued', run_after=now))
+    db.session.execute(db.update(Job).where(stale).values(status='failed', error='timeout', finished_at=now, expires_at=now + timedelta(hours=app.config['JOB_RESULT_TTL_HOURS'])))
+    expired = [job_id for (job_id,) in db.session.query(Job.id).filter(Job.expires_at < now)]
+    if expired: Job.query.filter(Job.id.in_(expired)).delete(synchronize_session=False)
+    db.session.commit()
+    for job_id in expired: remove_job_files(job_id)
+    return len(expired)
+
+def run_pending_jobs(limit=None):
+    # 處理目前可執行的工作直到佇列清空，回傳處理筆數
+    n = 0
+    while limit is None or n < limit:
+        job = claim_job()
+        if job is None: break
+        run_job(job); n += 1
+    return n
+
+def job_worker_loop(stop):
+    last_reap = 0
+    while not stop.is_set():
+        with app.app_context():
+            try:
+                if time.monotonic() - last_reap > 60: reap_jobs(); last_reap = time.monotonic()
+                processed = run_pending_jobs(limit=10)
+            except Exception:
+                app.logger.exception('job worker error'); db.session.rollback(); processed = 0
+            metrics.flush()
+        if not processed: stop.wait(app.config['JOB_POLL_SECONDS'])
+
+_job_workers = []
+_job_workers_lock = threading.Lock()
+
+def start_job_workers(n=None, stop=None):
+    # web 程序在第一個請求時啟動；測試模式下不啟動，由呼叫端自行 run_pending_jobs()
+    n = app.config['JOB_WORKERS'] if n is None else n
+    if _job_workers or n <= 0 or (app.testing and stop is None): return _job_workers
+    with _job_workers_lock:
+        if not _job_workers:
+            stop = stop or threading.Event()
+            for i in range(n):
+                t = threading.Thread(target=job_worker_loop, args=(stop,), name=f'job-worker-{i}', daemon=True)
+                t.start(); _job_workers.append(t)
+    return _job_workers
+
+@app.before_request
+def ensure_job_workers():
+    if not _job_workers: start_job_workers()
+
+@job_handler('export_csv')
+def export_csv_job(job, params):
+    d_from = date.fromisoformat(params['from']) if params.get('from') else None
+    d_to = date.fromisoformat(params['to']) if params.get('to') else None
+    chunks = iter_csv(export_rows(job.user_id, d_from, d_to))
+    if params.get('gzip'): chunks = gzip_stream(chunks)
+    tmp = job_path(job.id, 'tmp')
+    with open(tmp, 'wb') as f:
+        for chunk in chunks: f.write(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+    os.replace(tmp, job_path(job.id, 'out'))
+    job.result_name = "finance_report" + (f"_{d_from or ''}_{d_to or ''}" if d_from or d_to else "") + ".csv" + (".gz" if params.get('gzip') else "")
+    return {"bytes": os.path.getsize(job_path(job.id, 'out'))}
+
+@job_handler('import_csv')
+def import_csv_job(job, params):
+    user = db.session.get(User, job.user_id)
+    had_any = db.session.query(db.session.query(AllTransaction.id).filter(AllTransaction.user_id == user.id).exists()).scalar()
+    with open(job_path(job.id, 'in'), 'rb') as f:
+        try: imported, errors = import_transactions(user.id, f, touch_user(user.id))
+        except UnicodeDecodeError: db.session.rollback(); imported, errors = 0, [(0, '檔案編碼須為 UTF-8')]
+    if imported: check_achievements(user, first_transaction=not had_any)
+    return {"imported": imported, "errors": [{"line": n, "error": e} for n, e in errors]}
+
+@job_handler('rebuild_aggregates')
+def rebuild_aggregates_job(job, params):
+    rebuild_balance(job.user_id)
+    MonthlyRollup.query.filter_by(user_id=job.user_id).delete(synchronize_session=False)
+    T = AllTransaction
+    y, m = func.extract('year', T.date), func.extract('month', T.date)
+    months = db.session.query(y, m).filter(T.user_id == job.user_id).distinct().all()
+    for yy, mm in months: rebuild_month_rollup(job.user_id, int(yy), int(mm))
+    touch_user(job.user_id)
+    return {"months": len(months)}
+
+@app.route('/jobs', methods=['GET', 'POST'])
+@login_required
+@user_context(max_queries={'GET': 2, 'POST': 4})
+def jobs():
+    if request.method == 'GET':
+        return jsonify(jobs=[job_json(j) for j in Job.query.filter_by(user_id=current_user.id).order_by(Job.id.desc()).limit(20)])
+    payload = request.get_json(silent=True) or {}
+    if not isinstance(payload, dict): return jsonify(error='請傳送 JSON 物件'), 400
+    kind = payload.get('kind')
+    if kind not in API_JOB_KINDS: return jsonify(error='未知的工作類型'), 400
+    if kind in PREMIUM_JOB_KINDS and not current_user.is_premium: return jsonify(error='此功能需付費會員'), 403
+    params = payload.get('params') or {}
+    if not isinstance(params, dict): return jsonify(error='params 須為物件'), 400
+    if kind == 'export_csv':
+        params, err = parse_export_params(params)
+        if err: return jsonify(error=err), 400
+    return job_accepted(kind, params)
+
+@app.route('/jobs/<int:job_id>')
+@login_required
+@user_context(max_queries=2)
+def job_status(job_id):
+    job = Job.query.filter_by(id=job_id, user_id=current_user.id).first()
+    if not job: return jsonify(error='查無此工作'), 404
+    return jsonify(job_json(job))
+
+@app.route('/jobs/<int:job_id>/download')
+@login_required
+@user_context(max_queries=2)
+def job_download(job_id):
+    job = Job.query.filter_by(id=job_id, user_id=current_user.id).first()
+    if not job: return jsonify(error='查無此工作'), 404
+    if job.status != 'done' or not job.result_name: return jsonify(error='工作尚未完成', status=job.status), 409
+    path = job_path(job.id, 'out')
+    if job.expires_at < datetime.utcnow() or not os.path.exists(path): return jsonify(error='檔案已過期，請重新匯出'), 410
+    return send_file(path, as_attachment=True, download_name=job.result_name, mimetype="application/gzip" if job.result_name.endswith('.gz') else "text/csv")
+
+# --- 多月趨勢分析 ---
+TREND_MIN_MONTHS, TREND_MAX_MONTHS = 3, 60
+
+def month_labels(end_year, end_month, n):
+    # 由 end 往回推 n 個月，回傳由舊到新的 YYYY-MM
+    idx = end_year * 12 + end_month - 1
+    return [f"{i // 12:04d}-{i % 12 + 1:02d}" for i in range(idx - n + 1, idx + 1)]
+
+def rolling_mean(a, window):
+    # 沿月份軸 (axis 0) 的移動平均；前幾個月以可用的月數平均
+    cs = np.cumsum(a, axis=0)
+    out = cs.copy()
+    out[window:] = cs[window:] - cs[:-window]
+    counts = np.minimum(np.arange(1, a.shape[0] + 1), window)
+    return out / (counts[:, None] if a.ndim == 2 else counts)
+
+def nan_list(a, digits=4):
+    return [None if np.isnan(v) else round(float(v), digits) for v in np.asarray(a, dtype=float)]
+
+def compute_trends(rows, labels, budgets):
+    # rows: (year_month, type, main_category, mood, total)；全部以 (月份 x 分類) 矩陣運算
+    m_index = {ym: i for i, ym in enumerate(labels)}
+    n_months = len(labels)
+    cols = list(zip(*rows)) if rows else [()] * 5
+    ym, types, cats, moods = (np.array(col, dtype=object) for col in cols[:4])
+    totals = np.array(cols[4], dtype=float)
+    mi = np.array([m_index[v] for v in ym], dtype=int)
+    is_exp, is_inc = types == 'expense', types == 'income'
+
+    categories = sorted(set(cats[is_exp].tolist()))
+    c_index = {c: i for i, c in enumerate(categories)}
+    ci = np.array([c_index.get(c, -1) for c in cats], dtype=int)
+    exp = np.zeros((n_months, len(categories)))
+    np.add.at(exp, (mi[is_exp], ci[is_exp]), totals[is_exp])
+    income = np.bincount(mi[is_inc], weights=totals[is_inc], minlength=n_months)
+    regret = np.bincount(mi[is_exp & (moods == 'regret')], weights=totals[is_exp & (moods == 'regret')], minlength=n_months)
+    expense = exp.sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        savings_rate = np.where(income > 0, (income - expense) / income, np.nan)
+        regret_ratio = np.where(expense > 0, regret / expense, np.nan)
+        prev = np.vstack([np.full((1, exp.shape[1]), np.nan), exp[:-1]])
+        mom_change = np.where(prev > 0, (exp - prev) / prev, np.nan)
+
+    # 各分類支出的線性趨勢斜率 (每月增減金額)
+    x = np.arange(n_months, dtype=float); xc = x - x.mean()
+    slope = (xc @ (exp - exp.mean(axis=0))) / (xc @ xc) if n_months > 1 else np.zeros(len(categories))
+
+    budget_cats = [c for c in categories if c in budgets]
+    budget_vec = np.array([budgets[c] for c in budget_cats], dtype=float)
+    budget_spent = exp[:, [c_index[c] for c in budget_cats]] if budget_cats else np.zeros((n_months, 0))
+    variance = budget_spent - budget_vec
+
+    return {
+        'months': labels,
+        'categories': categories,
+        'income': nan_list(income, 0), 'expense': nan_list(expense, 0),
+        'expense_avg3': nan_list(rolling_mean(expense, 3), 0), 'expense_avg6': nan_list(rolling_mean(expense, 6), 0),
+        'income_avg3': nan_list(rolling_mean(income, 3), 0), 'income_avg6': nan_list(rolling_mean(income, 6), 0),
+        'savings_rate': nan_list(savings_rate), 'savings_rate_avg3': nan_list(rolling_mean(np.nan_to_num(savings_rate), 3)),
+        'regret': nan_list(regret, 0), 'regret_ratio': nan_list(regret_ratio),
+        'category_expense': {c: nan_list(exp[:, i], 0) for i, c in enumerate(categories)},
+        'category_avg3': {c: nan_list(col, 0) for c, col in zip(categories, rolling_mean(exp, 3).T)},
+        'category_mom_change': {c: nan_list(col) for c, col in zip(categories, mom_change.T)},
+        'category_slope': {c: round(float(v), 1) for c, v in zip(categories, slope)},
+        'budget_categories': budget_cats, 'budget_limits': nan_list(budget_vec, 0),
+        'budget_variance': {c: nan_list(col, 0) for c, col in zip(budget_cats, variance.T)},
+        'budget_over_months': {c: int(n) for c, n in zip(budget_cats, (variance > 0).sum(axis=0))},
+    }
+
+def backfill_month_rollups(user_id, year_months):
+    # 一次 GROUP BY 補齊多個月份的彙總；只掃這些月份的日期區間，沒有交易的月份是空的索引範圍
+    T = AllTransaction
+    y, m = func.extract('year', T.date), func.extract('month', T.date)
+    mood = func.coalesce(T.mood, 'neutral')
+    ranges = [month_range(int(ym[:4]), int(ym[5:])) for ym in year_months]
+    src = db.session.query(y, m, T.type, T.main_category, mood, func.sum(T.amount), func.count(T.id)).filter(
+        T.user_id == user_id, or_(*[and_(T.date >= start, T.date < end) for start, end in ranges])).group_by(y, m, T.type, T.main_category, mood)
+    rows = [dict(user_id=user_id, year_month=f"{int(yy):04d}-{int(mm):02d}", type=t_type, main_category=cat, mood=t_mood, total=total or 0, count=n)
+            for yy, mm, t_type, cat, t_mood, total, n in src]
+    if not rows: return []
+    MonthlyRollup.query.filter(MonthlyRollup.user_id == user_id, MonthlyRollup.year_month.in_({r['year_month'] for r in rows})).delete(synchronize_session=False)
+    db.session.execute(MonthlyRollup.__table__.insert(), rows); db.session.commit()
+    return rows
+
+def load_trends(user_id, months):
+    today = datetime.now()
+    labels = month_labels(today.year, today.month, months)
+    rows = db.session.query(MonthlyRollup.year_month, MonthlyRollup.type, MonthlyRollup.main_category, MonthlyRollup.mood, MonthlyRollup.total, MonthlyRollup.count).filter(
+        MonthlyRollup.user_id == user_id, MonthlyRollup.year_month >= labels[0], MonthlyRollup.year_month <= labels[-1]).all()
+    # 彙總只在寫入或開啟 /analysis 時建立；視窗內沒有彙總的月份先從交易補齊，不顯示成 0
+    missing = sorted(set(labels) - {r.year_month for r in rows})
+    if missing:
+        read_primary()
+        rows += [(r['year_month'], r['type'], r['main_category'], r['mood'], r['total'], r['count']) for r in backfill_month_rollups(user_id, missing)]
+    rows = [r[:5] for r in rows if r[5] > 0]
+    budgets = {b.category: b.amount for b in Budget.query.filter_by(user_id=user_id)}
+    return compute_trends(rows, labels, budgets)
+
+def parse_trend_months(value):
+    try: return max(TREND_MIN_MONTHS, min(TREND_MAX_MONTHS, int(value)))
+    except (TypeError, ValueError): return 12
+
+@app.route('/trends')
+@login_required
+@replica_reads
+@user_context(max_queries=7)
+def trends():
+    if not current_user.is_premium: flash('🔒 多月趨勢為付費功能，請先升級。'); return redirect(url_for('settings'))
+    months = parse_trend_months(request.args.get('months'))
+    return cached_page(lambda: render_template('trends.html', user=current_user, months=months, trends=load_trends(current_user.id, months)), months, datetime.now().strftime('%Y-%m'))
+
+@app.route('/api/trends')
+@login_required
+@replica_reads
+@user_context(max_queries=6)
+def api_trends():
+    if not current_user.is_premium: return jsonify(error='多月趨勢為付費功能'), 403
+    return jsonify(load_trends(current_user.id, parse_trend_months(request.args.get('months'))))
+
+# --- 同步 API (v1) ---
+SYNC_PAGE_SIZE = 500
+SYNC_MAX_PAGE_SIZE = 2000
+
+def sync_changes(user_id, since, until, after=None, limit=SYNC_PAGE_SIZE):
+    # 回傳 row_version 在 (since, until] 之間的變更；交易依 (row_version, id) keyset 分頁，預算、訂閱與刪除紀錄只在第一頁
+    T = AllTransaction
+    q = db.session.query(*tx_columns()).filter(T.user_id == user_id, T.row_version > since, T.row_version <= until)
+    if after:
+        a_version, a_id = after
+        q = q.filter(or_(T.row_version > a_version, and_(T.row_version == a_version, T.id > a_id)))
+    rows = q.order_by(T.row_version, T.id).limit(limit + 1).all()
+    next_page = f"{since}.{until}.{rows[limit - 1].row_version}.{rows[limit - 1].id}" if len(rows) > limit else None
+    changes = {'transactions': [transaction_json(t) for t in rows[:limit]], 'budgets': [], 'subscriptions': [],
+               'deleted': {'transactions': [], 'budgets': [], 'subscriptions': []}}
+    if after: return changes, next_page
+    changes['budgets'] = [{"id": b.id, "category": b.category, "amount": b.amount} for b in Budget.query.filter(
+        Budget.user_id == user_id, Budget.row_version > since, Budget.row_version <= until).order_by(Budget.id)]
+    changes['subscriptions'] = [{"id": s.id, "name": s.name, "amount": s.amount} for s in Subscription.query.filter(
+        Subscription.user_id == user_id, Subscription.row_version > since, Subscription.row_version <= until).order_by(Subscription.id)]
+    if since >= 0:
+        for kind, object_id in db.session.query(Tombstone.kind, Tombstone.object_id).filter(
+                Tombstone.user_id == user_id, Tombstone.row_version > since, Tombstone.row_version <= until).order_by(Tombstone.id):
+            changes['deleted'][kind + 's'].append(object_id)
+    return changes, next_page
+
+def sync_response(cursor, changes, next_page, **extra):
+    # has_more 為 true 時以 GET /api/v1/sync?page=<next_page> 取下一頁，全部取完後才保存 cursor
+    return jsonify(cursor=cursor, has_more=next_page is not None, next_page=next_page, changes=changes, **extra)
+
+def parse_cursor(value):
+    try: return int(value) if value is not None else -1
+    except (TypeError, ValueError): return None
+
+def parse_sync_page(value):
+    # next_page 權杖 -> (since, until, (row_version, id)) 或 None
+    try:
+        since, until, a_version, a_id = map(int, value.split('.'))
+        return since, until, (a_version, a_id)
+    except (AttributeError, ValueError): return None
+
+def parse_sync_limit(value):
+    try: return max(1, min(SYNC_MAX_PAGE_SIZE, int(value)))
+    except (TypeError, ValueError): return SYNC_PAGE_SIZE
+
+@app.route('/api/v1/sync', methods=['GET'])
+@login_required
+@user_context(max_queries=5)
+def api_sync_pull():
+    # 不讀副本：cursor 取自主庫的 data_version，副本延遲時客戶端會存下跳過未複製變更的 cursor
+    limit = parse_sync_limit(request.args.get('limit'))
+    if request.args.get('page'):
+        page = parse_sync_page(request.args['page'])
+        if page is None: return jsonify(error='page 格式錯誤'), 400
+        since, until, after = page
+    else:
+        since, until, after = parse_cursor(request.args.get('cursor')), current_user.data_version, None
+        if since is None: return jsonify(error='cursor 格式錯誤'), 400
+    changes, next_page = sync_changes(current_user.id, since, until, after, limit)
+    return sync_response(until, changes, next_page)
+
+@app.route('/api/v1/sync', methods=['POST'])
+@login_required
+def api_sync_push():
+    # 先驗證整批資料，再於同一個 DB transaction 套用新增/刪除，並回傳 cursor 之後的變更 (第一頁)
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict): return jsonify(error='請傳送 JSON 物件'), 400
+    cursor = parse_cursor(payload.get('cursor'))
+    if cursor is None: return jsonify(error='cursor 格式錯誤'), 400
+    tx_ops, budget_ops, sub_ops = (payload.get(k) or {} for k in ('transactions', 'budgets', 'subscriptions'))
+    if not all(isinstance(ops, dict) for ops in (tx_ops, budget_ops, sub_ops)): return jsonify(error='格式錯誤'), 400
+    if (budget_ops or sub_ops) and not current_user.is_premium: return jsonify(error='預算與訂閱為付費功能'), 403
+
+    errors, tx_creates, budget_upserts, sub_creates = [], [], [], []
+    for kind, ops, keys in (('transaction', tx_ops, ('create', 'delete')), ('budget', budget_ops, ('upsert', 'delete')), ('subscription', sub_ops, ('create', 'delete'))):
+        for key in keys:
+            if not isinstance(ops.get(key) or [], list): errors.append({"kind": kind, "op": key, "error": '須為陣列'})
+    if errors: return jsonify(error='資料驗證失敗，整批未寫入', errors=errors), 400
+    for i, d in enumerate(tx_ops.get('create') or []):
+        data, err = parse_transaction_json(d)
+        if err: errors.append({"kind": "transaction", "index": i, "error": err})
+        else: tx_creates.append((d.get('client_id'), data))
+    for i, d in enumerate(budget_ops.get('upsert') or []):
+        if not isinstance(d, dict) or not isinstance(d.get('category'), str) or not d['category'] or len(d['category']) > 50 or not is_json_int(d.get('amount')):
+            errors.append({"kind": "budget", "index": i, "error": '格式錯誤'})
+        else: budget_upserts.append(d)
+    for i, d in enumerate(sub_ops.get('create') or []):
+        if not isinstance(d, dict) or not isinstance(d.get('name'), str) or not d['name'] or len(d['name']) > 100 or not is_json_int(d.get('amount')):
+            errors.append({"kind": "subscription", "index": i, "error": '格式錯誤'})
+        else: sub_creates.append((d.get('client_id'), d))
+    if errors: return jsonify(error='資料驗證失敗，整批未寫入', errors=errors), 400
+    delete_tx = [i for i in tx_ops.get('delete') or [] if is_json_int(i)]
+    delete_budgets = [c for c in budget_ops.get('delete') or [] if isinstance(c, str)]
+    delete_subs = [i for i in sub_ops.get('delete') or [] if is_json_int(i)]
+
+    # 同一批新增多筆時，逐筆檢查會互相看到對方；在寫入前判斷是否為第一筆
+    had_any = db.session.query(db.session.query(AllTransaction.id).filter(AllTransaction.user_id == current_user.id).exists()).scalar() if tx_creates else True
+    version = touch_user(current_user.id)
+    created = {'transactions': {}, 'subscriptions': {}}
+    new_trans = [(client_id, Transaction(user_id=current_user.id, row_version=version, **data)) for client_id, data in tx_creates]
+    new_subs = [(client_id, Subscription(user_id=current_user.id, name=d['name'], amount=d['amount'], row_version=version)) for client_id, d in sub_creates]
+    for model in (Transaction, TransactionArchive) if delete_tx else ():
+        for t in model.query.filter(model.user_id == current_user.id, model.id.in_(delete_tx)): delete_transaction(t, version)
+    # 逐筆加入再更新彙總：record_transaction 的 flush 若一次帶入整批，缺少的餘額或月彙總重建時已含後面的交易，之後又被逐筆加一次
+    for client_id, t in new_trans:
+        db.session.add(t); record_transaction(t); check_achievements(current_user, transaction=t, first_transaction=not had_any)
+        if client_id is not None: created['transactions'][str(client_id)] = t.id
+
+    existing = {b.category: b for b in Budget.query.filter_by(user_id=current_user.id)} if budget_upserts or delete_budgets else {}
+    for d in budget_upserts:
+        b = existing.get(d['category'])
+        if b: b.amount = d['amount']; b.row_version = version
+        else: b = existing[d['category']] = Budget(user_id=current_user.id, category=d['category'], amount=d['amount'], row_version=version); db.session.add(b)
+    for cat in delete_budgets:
+        b = existing.pop(cat, None)
+        if b is None: continue
+        db.session.delete(b); db.session.flush(); record_tombstone(current_user.id, 'budget', b.id, version)
+    if budget_upserts: check_achievements(current_user, budget=True)
+
+    if new_subs: db.session.add_all([sub for _, sub in new_subs]); db.session.flush(); check_achievements(current_user, subscription=True)
+    for client_id, sub in new_subs:
+        if client_id is not None: created['subscriptions'][str(client_id)] = sub.id
+    for sub in Subscription.query.filter(Subscription.user_id == current_user.id, Subscription.id.in_(delete_subs)) if delete_subs else ():
+        db.session.delete(sub); record_tombstone(current_user.id, 'subscription', sub.id, version)
+
+    db.session.commit()
+    changes, next_page = sync_changes(current_user.id, cursor, version, limit=parse_sync_limit(payload.get('limit')))
+    return sync_response(version, changes, next_page, created=created)
 
 @app.route('/settings')
 @login_required
+@user_context('achievements', 'budgets', 'subscriptions', max_queries=6)
 def settings():
-    user_achievements = [ua.achievement_id for ua in current_user.achievements]
-    all_achievements = Achievement.query.all()
-    ach_list = [{"name": a.name, "desc": a.description, "icon": a.icon, "unlocked": a.id in user_achievements} for a in all_achievements]
+    user_achievements = {ua.achievement_id for ua in current_user.achievements}
+    ach_list = [{**a, "unlocked": a['id'] in user_achievements} for a in get_achievement_catalog().values()]
     current_budgets = {b.category: b.amount for b in current_user.budgets}
-    return render_template('settings.html', user=current_user, achievements=ach_list, current_budgets=current_budgets)
+    jobs = [job_json(j) for j in Job.query.filter_by(user_id=current_user.id).order_by(Job.id.desc()).limit(5)]
+    return render_template('settings.html', user=current_user, achievements=ach_list, current_budgets=current_budgets,
+                           jobs=jobs, job_kind_labels=JOB_KIND_LABELS, job_status_labels=JOB_STATUS_LABELS)
 
 @app.route('/delete/<int:id>')
 @login_required
 def delete(id):
-    t = Transaction.query.get_or_404(id)
-    if t.user_id == current_user.id: db.session.delete(t); db.session.commit()
+    t = db.session.get(Transaction, id) or TransactionArchive.query.filter_by(id=id).first_or_404()
+    if t.user_id == current_user.id: delete_transaction(t, touch_user(current_user.id)); db.session.commit()
     return redirect(request.referrer or url_for('index'))
 
+@app.cli.command('archive-years')
+@click.option('--year', 'years', type=int, multiple=True, help='指定年度，可重複；預設為保留年限之前仍有熱資料或尚未完成的年度')
+@click.option('--batch-size', type=int, help='每批搬移筆數 (預設 ARCHIVE_BATCH_SIZE)')
+@click.option('--verify-only', is_flag=True, help='只核對已封存年度')
+def archive_years_command(years, batch_size, verify_only):
+    cutoff = archive_cutoff_year()
+    if not years and verify_only: years = {a.year for a in ArchiveYear.query}
+    elif not years:
+        y = func.extract('year', Transaction.date)
+        years = {int(v) for (v,) in db.session.query(y).filter(Transaction.date < date(cutoff, 1, 1)).distinct()}
+        years |= {a.year for a in ArchiveYear.query.filter(ArchiveYear.status != 'verified')}
+    failed = 0
+    for year in sorted(years):
+        if year >= cutoff: click.echo(f"{year}: within ARCHIVE_KEEP_YEARS, skipped"); continue
+        try:
+            if verify_only: n, total = verify_archive_year(year); click.echo(f"{year}: ok, {n} rows / {total}"); continue
+            moved, (n, total) = archive_year(year, batch_size, progress=lambda y, m: click.echo(f"{y}: {m} rows moved"))
+            click.echo(f"{year}: verified, {moved} rows moved this run, {n} rows / {total} archived")
+        except ArchiveVerificationError as e: failed += 1; click.echo(f"verification failed: {e}", err=True)
+    if failed: raise SystemExit(1)
+
+@app.cli.command('db-init')
+def db_init_command():
+    applied, seeded = init_database()
+    click.echo(f"schema at version {max(applied_migrations())}, {seeded} achievements seeded")
+
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    applied, seeded = upgrade_database()
+    click.echo(f"applied migrations: {', '.join(map(str, applied)) or 'none'}; {seeded} achievements seeded")
+
+@app.cli.command('rebuild-balances')
+@click.option('--check', is_flag=True, help='只檢查不修正')
+def rebuild_balances_command(check):
+    # 以 GROUP BY 重算全部使用者 (封存年度讀 YearlySummary)，與 UserBalance 比對
+    actual = {}
+    hot = db.session.query(Transaction.user_id, Transaction.type, func.sum(Transaction.amount), func.count(Transaction.id)).group_by(Transaction.user_id, Transaction.type)
+    cold = db.session.query(YearlySummary.user_id, YearlySummary.type, func.sum(YearlySummary.total), func.sum(YearlySummary.count)).group_by(YearlySummary.user_id, YearlySummary.type)
+    for user_id, t_type, total, n in hot.all() + cold.all():
+        inc, exp, cnt = actual.get(user_id, (0, 0, 0))
+        if t_type == 'income': inc += total or 0
+        else: exp += total or 0
+        actual[user_id] = (inc, exp, cnt + n)
+    stored = {b.user_id: b for b in UserBalance.query.all()}
+    mismatched = 0
+    for (user_id,) in db.session.query(User.id):
+        want = actual.get(user_id, (0, 0, 0))
+        bal = stored.get(user_id)
+        if bal is not None and (bal.income, bal.expense, bal.tx_count) == want: continue
+        mismatched += 1
+        click.echo(f"user {user_id}: stored={None if bal is None else (bal.income, bal.expense, bal.tx_count)} actual={want}")
+        if not check:
+            if bal is None: bal = UserBalance(user_id=user_id); db.session.add(bal)
+            bal.income, bal.expense, bal.tx_count = want
+    if not check: db.session.commit()
+    click.echo(f"{mismatched} mismatched" + ("" if check else ", fixed"))
+    if check and mismatched: raise SystemExit(1)
+
+@app.cli.command('backfill-rollups')
+@click.option('--user-id', type=int, help='只重建指定使用者')
+def backfill_rollups_command(user_id):
+    q = MonthlyRollup.query
+    if user_id: q = q.filter_by(user_id=user_id)
+    q.delete(synchronize_session=False)
+    T = AllTransaction
+    y, m = func.extract('year', T.date), func.extract('month', T.date)
+    mood = func.coalesce(T.mood, 'neutral')
+    src = db.session.query(T.user_id, y, m, T.type, T.main_category, mood, func.sum(T.amount), func.count(T.id))
+    if user_id: src = src.filter(T.user_id == user_id)
+    rows = [dict(user_id=uid, year_month=f"{int(yy):04d}-{int(mm):02d}", type=t_type, main_category=cat, mood=t_mood, total=total or 0, count=n)
+            for uid, yy, mm, t_type, cat, t_mood, total, n in src.group_by(T.user_id, y, m, T.type, T.main_category, mood)]
+    if rows: db.session.execute(MonthlyRollup.__table__.insert(), rows)
+    db.session.commit()
+    click.echo(f"{len(rows)} rollup rows written")
+
+@app.cli.command('run-jobs')
+@click.option('--workers', default=2, help='執行緒數')
+@click.option('--once', is_flag=True, help='處理完目前佇列後結束')
+def run_jobs_command(workers, once):
+    # 獨立的背景工作程序；搭配 JOB_WORKERS=0 讓 web 程序只負責排入
+    if once:
+        expired = reap_jobs()
+        click.echo(f"{run_pending_jobs()} jobs processed, {expired} expired jobs removed"); return
+    stop = threading.Event()
+    threads = start_job_workers(workers, stop)
+    click.echo(f"job worker started with {len(threads)} threads (Ctrl+C to stop)")
+    try:
+        while any(t.is_alive() for t in threads): time.sleep(1)
+    except KeyboardInterrupt:
+        stop.set()
+        for t in threads: t.join()
+
+@app.cli.command('ecpay-simulate')
+@click.argument('trade_no', required=False)
+@click.option('--user-id', type=int, help='未指定訂單時，替此使用者建立一筆待付款訂單')
+@click.option('--rtn-code', default='1', help='1 為付款成功')
+@click.option('--repeat', default=1, help='重送次數，用來驗證重複通知')
+@click.option('--workers', default=1, help='同時送出的連線數')
+@click.option('--url', help='送往執行中的服務，例如 http://localhost:5000/ecpay/notify；預設在程序內處理')
+def ecpay_simulate_command(trade_no, user_id, rtn_code, repeat, workers, url):
+    # 本機假金流：依綠界 ReturnURL 格式簽章後送出付款通知
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import Counter
+    import urllib.request, urllib.error
+    if not trade_no:
+        if not user_id: raise click.UsageError('請指定 TRADE_NO 或 --user-id')
+        trade_no = new_trade_no()
+        db.session.add(Order(trade_no=trade_no, amount=PREMIUM_PRICE, user_id=user_id, status='Pending')); db.session.commit()
+    order = Order.query.filter_by(trade_no=trade_no).first()
+    if not order: raise click.UsageError(f'查無訂單 {trade_no}')
+    now = datetime.now().strftime('%Y/%m/%d %H:%M:%S')
+    params = {'MerchantID': ECPAY_MERCHANT_ID, 'MerchantTradeNo': trade_no, 'StoreID': '', 'RtnCode': rtn_code, 'RtnMsg': '交易成功' if rtn_code == '1' else '交易失敗',
+              'TradeNo': f"{secrets.randbelow(10 ** 14):014d}", 'TradeAmt': str(order.amount), 'PaymentDate': now, 'PaymentType': 'Credit_CreditCard',
+              'PaymentTypeChargeFee': '0', 'TradeDate': order.date_created.strftime('%Y/%m/%d %H:%M:%S'), 'SimulatePaid': '1',
+              'CustomField1': '', 'CustomField2': '', 'CustomField3': '', 'CustomField4': ''}
+    params['CheckMacValue'] = get_mac_value(params)
+    def send(_):
+        if not url:
+            r = app.test_client().post('/ecpay/notify', data=params)
+            return r.status_code, r.get_data(as_text=True)
+        req = urllib.request.Request(url, data=urllib.parse.urlencode(params).encode(), method='POST')
+        try:
+            with urllib.request.urlopen(req, timeout=10) as r: return r.status, r.read().decode()
+        except urllib.error.HTTPError as e: return e.code, e.read().decode()
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool: results = Counter(pool.map(send, range(repeat)))
+    db.session.expire_all()
+    click.echo(f"{trade_no}: {repeat} callbacks in {time.perf_counter() - t0:.2f}s, order status {Order.query.filter_by(trade_no=trade_no).first().status}")
+    for (status, body), n in sorted(results.items()): click.echo(f"  {status} {body} x{n}")
+
 @app.errorhandler(404)
 def page_not_found(e): return render_template('404.html'), 404
 @app.errorhandler(500)
 def internal_server_error(e): return render_template('500.html'), 500
 
 if __name__ == '__main__':
+    with app.app_context(): init_database() # 本機開發直接執行時自動建立/升級資料庫
     app.run(debug=True, port=5000)
\ No newline at end of file
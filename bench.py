@@ -0,0 +1,215 @@
+# 效能基準測試：產生合成資料，以 Flask test client 量測各路由的延遲、查詢數與記憶體峰值
+#
+#   python bench.py --sizes 1000,100000                  # SQLite 暫存檔
+#   python bench.py --database-url postgresql://localhost/finance_bench
+#   python bench.py --save-baseline bench_baseline.json  # 存成基準
+#   python bench.py --compare bench_baseline.json        # 與基準比較，退步超過容忍值時 exit 1
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+EXPENSE_CATEGORIES = [("餐飲", 45), ("交通", 18), ("購物", 15), ("娛樂", 10), ("房租", 2), ("其他", 10)]
+EXPENSE_ITEMS = {
+    "餐飲": [("早餐", 40, 120), ("午餐", 80, 250), ("晚餐", 100, 600), ("咖啡", 50, 180), ("飲料", 30, 90)],
+    "交通": [("捷運", 20, 60), ("公車", 15, 30), ("計程車", 150, 600), ("加油", 500, 1800)],
+    "購物": [("衣服", 300, 3000), ("日用品", 50, 800), ("3C", 500, 30000)],
+    "娛樂": [("電影", 250, 400), ("唱歌", 300, 1200), ("遊戲", 100, 2000)],
+    "房租": [("房租", 8000, 25000)],
+    "其他": [("醫療", 150, 2000), ("禮物", 300, 3000), ("雜支", 20, 500)],
+}
+INCOME_ITEMS = [("薪水", "月薪", 35000, 80000), ("獎金", "績效獎金", 5000, 60000), ("投資", "股利", 500, 20000), ("兼職", "接案", 2000, 15000)]
+MOODS = [("neutral", 70), ("happy", 20), ("regret", 10)]
+SIZES = {"1k": 1000, "100k": 100_000, "1m": 1_000_000}
+
+
+def weighted(rng, pairs):
+    return rng.choices([p[0] for p in pairs], weights=[p[1] for p in pairs])[0]
+
+
+def generate_rows(user_id, n, years, seed, end=None):
+    # 依時間均勻分布，週末消費較多；約 5% 為收入，每月固定一筆薪水。逐筆產生，不一次建立整段歷史
+    rng = random.Random(seed)
+    end = end or date.today()
+    start = end - timedelta(days=365 * years)
+    span = (end - start).days
+    month, salary_left = None, 0
+    for i in range(n):
+        d = start + timedelta(days=int(span * i / n))
+        if d.weekday() >= 5 and rng.random() < 0.3: d = d - timedelta(days=rng.randint(0, 1))
+        if (d.year, d.month) != month: month, salary_left = (d.year, d.month), 1
+        if salary_left or rng.random() < 0.03:
+            cat, item, lo, hi = INCOME_ITEMS[0] if salary_left else rng.choice(INCOME_ITEMS[1:])
+            salary_left = 0
+            yield dict(user_id=user_id, date=d, amount=rng.randint(lo, hi), type="income", main_category=cat, item_name=item, note="", mood="happy", row_version=0)
+            continue
+        cat = weighted(rng, EXPENSE_CATEGORIES)
+        item, lo, hi = rng.choice(EXPENSE_ITEMS[cat])
+        yield dict(user_id=user_id, date=d, amount=rng.randint(lo, hi), type="expense", main_category=cat, item_name=item,
+                   note="" if rng.random() < 0.8 else "合成資料", mood=weighted(rng, MOODS), row_version=0)
+
+
+def create_user(A, username, n, years, seed, premium=True):
+    # 每 IMPORT_BATCH_SIZE 筆寫入一次並記下涉及的月份，記憶體用量與總筆數無關；最後重建衍生彙總
+    u = A.User(username=username, display_name=username, bio="benchmark", is_premium=premium)
+    u.set_password("Bench1234")
+    A.db.session.add(u); A.db.session.commit()
+    months, batch = set(), []
+    for row in generate_rows(u.id, n, years, seed):
+        batch.append(row); months.add((row["date"].year, row["date"].month))
+        if len(batch) >= A.IMPORT_BATCH_SIZE: A.bulk_insert_transactions(batch); batch = []
+    if batch: A.bulk_insert_transactions(batch)
+    A.rebuild_balance(u.id)
+    months = sorted(months)
+    for y, m in months: A.rebuild_month_rollup(u.id, y, m)
+    A.db.session.add(A.Budget(user_id=u.id, category="餐飲", amount=8000))
+    A.db.session.add(A.Subscription(user_id=u.id, name="Netflix", amount=390))
+    A.db.session.commit()
+    last = months[-1] if months else (date.today().year, date.today().month)
+    return u.id, f"{last[0]:04d}-{last[1]:02d}"
+
+
+class NullCache:
+    def get(self, key): return None
+    def set(self, key, value): pass
+
+
+class QueryCounter:
+    def __init__(self): self.count = 0
+    def __call__(self, *args): self.count += 1
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values: return 0.0
+    k = (len(values) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def routes_for(month):
+    return [
+        ("index", "GET", f"/?month={month}"),
+        ("ledger_api", "GET", f"/api/ledger?month={month}&limit=200"),
+        ("analysis", "GET", f"/analysis?month={month}"),
+        ("analysis_details", "GET", f"/analysis/details?month={month}&type=expense&category=餐飲"),
+        ("settings", "GET", "/settings"),
+        ("export_job", "JOB", "/export_csv?format=json"),
+        ("sync_pull", "GET", "/api/v1/sync"),
+        ("add_transaction", "POST", "/"),
+    ]
+
+
+def request_once(client, method, path, i, A=None):
+    if method == "JOB":
+        # 排入背景匯出後在本程序內執行完畢，量測整體處理時間
+        r = client.get(path)
+        if r.status_code != 202: raise RuntimeError(f"{method} {path} -> {r.status_code}")
+        with A.app.app_context(): A.run_pending_jobs()
+        r = client.get(client.get(r.get_json()["status_url"]).get_json()["download_url"])
+    elif method == "POST":
+        data = {"amount": str(50 + i % 400), "type": "expense", "main_category": "餐飲", "item_name": "bench", "note": "", "mood": "neutral", "date": date.today().strftime("%Y-%m-%d")}
+        r = client.post(path, data=data)
+    else: r = client.get(path)
+    r.get_data(); r.close() # 串流回應需讀完才算完成
+    if r.status_code >= 400: raise RuntimeError(f"{method} {path} -> {r.status_code}")
+
+
+def bench_route(client, counter, method, path, iterations, warmup, A=None):
+    for i in range(warmup): request_once(client, method, path, i, A)
+    latencies, queries = [], []
+    for i in range(iterations):
+        counter.count = 0
+        t0 = time.perf_counter(); request_once(client, method, path, i, A); latencies.append((time.perf_counter() - t0) * 1000)
+        queries.append(counter.count)
+    tracemalloc.start(); tracemalloc.reset_peak()
+    request_once(client, method, path, iterations, A)
+    peak = tracemalloc.get_traced_memory()[1]; tracemalloc.stop()
+    return {"p50_ms": round(percentile(latencies, 50), 2), "p95_ms": round(percentile(latencies, 95), 2), "p99_ms": round(percentile(latencies, 99), 2),
+            "max_ms": round(max(latencies), 2), "queries": max(queries), "peak_kib": round(peak / 1024, 1)}
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for size, routes in results.items():
+        for name, cur in routes.items():
+            base = baseline.get(size, {}).get(name)
+            if not base: continue
+            for key in ("p50_ms", "p95_ms", "queries", "peak_kib"):
+                old, new = base[key], cur[key]
+                if key == "queries": worse = new > old
+                else: worse = old > 0 and (new - old) / old > tolerance
+                flag = "  <-- REGRESSION" if worse else ""
+                if worse: regressions.append(f"{size}/{name}/{key}")
+                print(f"  {size:>6} {name:<18} {key:<8} {old:>10} -> {new:>10}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="記帳管家效能基準測試")
+    parser.add_argument("--sizes", default="1k,100k", help="逗號分隔：1k / 100k / 1m 或直接給筆數")
+    parser.add_argument("--years", type=int, default=5, help="合成資料涵蓋年數")
+    parser.add_argument("--iterations", type=int, default=30)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--database-url", help="例如 postgresql://localhost/finance_bench；預設使用 SQLite 暫存檔")
+    parser.add_argument("--page-cache", action="store_true", help="保留頁面快取 (預設關閉以量測實際運算)")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--save-baseline")
+    parser.add_argument("--compare")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="延遲/記憶體可接受的退步比例")
+    args = parser.parse_args(argv)
+
+    # 必須在 import app 之前設定連線字串
+    tmpdir = None
+    if args.database_url: os.environ["DATABASE_URL"] = args.database_url
+    else:
+        tmpdir = tempfile.mkdtemp(prefix="finance-bench-")
+        os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tmpdir, "bench.db")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as A
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    A.app.config.update(TESTING=True, QUERY_BUDGET_STRICT=False, JOB_STORAGE_DIR=tempfile.mkdtemp(prefix="finance-bench-jobs-"))
+    with A.app.app_context(): A.init_database()
+    if not args.page_cache: A._render_cache = NullCache()
+    counter = QueryCounter()
+    event.listen(Engine, "before_cursor_execute", counter)
+
+    results = {}
+    run_id = int(time.time())
+    for label in args.sizes.split(","):
+        label = label.strip().lower()
+        n = SIZES.get(label) or int(label)
+        username = f"bench_{label}_{run_id}"
+        with A.app.app_context():
+            t0 = time.perf_counter()
+            user_id, month = create_user(A, username, n, args.years, args.seed)
+            print(f"[{label}] generated {n} transactions in {time.perf_counter() - t0:.1f}s (month {month})")
+        client = A.app.test_client()
+        client.post("/login", data={"username": username, "password": "Bench1234"})
+        results[label] = {}
+        for name, method, path in routes_for(month):
+            stats = bench_route(client, counter, method, path, args.iterations, args.warmup, A)
+            results[label][name] = stats
+            print(f"  {name:<18} p50 {stats['p50_ms']:>8} ms  p95 {stats['p95_ms']:>8} ms  p99 {stats['p99_ms']:>8} ms  queries {stats['queries']:>3}  peak {stats['peak_kib']:>9} KiB")
+
+    with open(args.output, "w", encoding="utf-8") as f: json.dump(results, f, indent=2, ensure_ascii=False)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f: json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"baseline saved to {args.save_baseline}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f: baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions: print("regressions: " + ", ".join(regressions)); return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
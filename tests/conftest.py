@@ -0,0 +1,50 @@
+import itertools
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py 在 import 時就讀取 DATABASE_URL，必須先指到暫存的 SQLite
+TMP_DIR = tempfile.mkdtemp(prefix='finance-test-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(TMP_DIR, 'test.db')
+os.environ.pop('DATABASE_REPLICA_URL', None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as finance  # noqa: E402
+
+PASSWORD = 'Passw0rdX'
+
+
+class NullCache:
+    # 關閉頁面快取，每次 GET 都實際渲染，量到的是最差情況的查詢數
+    def get(self, key): return None
+    def set(self, key, value): pass
+
+
+@pytest.fixture(scope='session')
+def app():
+    finance.app.config.update(TESTING=True, QUERY_BUDGET_STRICT=True, RENDER_CACHE_BACKEND=NullCache(),
+                              JOB_STORAGE_DIR=os.path.join(TMP_DIR, 'jobs'), METRICS_DIR=os.path.join(TMP_DIR, 'metrics'))
+    finance._render_cache = None
+    with finance.app.app_context(): finance.init_database()
+    return finance.app
+
+
+_usernames = itertools.count()
+
+
+@pytest.fixture
+def login(app):
+    # 每次呼叫建立一位新使用者並回傳已登入的 test client，沒有任何餘額或月彙總 (冷路徑)
+    def make(premium=True):
+        username = f'user{next(_usernames)}'
+        client = app.test_client()
+        client.post('/register', data={'username': username, 'password': PASSWORD})
+        with app.app_context():
+            user = finance.User.query.filter_by(username=username).one()
+            user.is_premium = premium; finance.db.session.commit()
+            client.user_id = user.id
+        assert client.post('/login', data={'username': username, 'password': PASSWORD}).status_code == 302
+        return client
+    return make
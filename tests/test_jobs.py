@@ -0,0 +1,30 @@
+# 背景工作佇列的行為：輸入驗證與逾時後的結果寫入
+import io
+
+import pytest
+
+import app as finance
+
+
+@pytest.mark.parametrize('body', [[1], {'kind': 'export_csv', 'params': 'x'}])
+def test_jobs_rejects_malformed_json(login, body):
+    assert login().post('/jobs', json=body).status_code == 400
+
+
+def test_reclaimed_job_discards_stale_attempt(app, login, monkeypatch):
+    # 逾時被重新排隊並由另一個 worker 搶走的匯入，原本的執行緒完成時不能再寫入一次
+    client = login()
+    body = '﻿日期,收支類型,主分類,細項,金額,消費情緒,備註\n2024-05-01,支出,餐飲,早餐,80,😐 需要,\n'.encode('utf-8')
+    assert client.post('/import_csv?format=json', data={'file': (io.BytesIO(body), 'import.csv')}).status_code == 202
+    with app.app_context():
+        stale = finance.claim_job()
+        assert stale.attempts == 1
+        with app.app_context():
+            # 另一個 worker (各自的 session)：逾時後重新排隊並再次搶到
+            monkeypatch.setitem(app.config, 'JOB_TIMEOUT_SECONDS', -1)
+            finance.reap_jobs()
+            fresh = finance.claim_job()
+            assert fresh.id == stale.id and fresh.attempts == 2
+        assert finance.run_job(stale) is None
+        with app.app_context(): assert finance.run_job(fresh).status == 'done'
+        assert finance.db.session.query(finance.AllTransaction).filter_by(user_id=client.user_id).count() == 1
@@ -0,0 +1,116 @@
+# 以 test client 走過每個宣告 max_queries 的路由；TESTING 下超過預算會拋出 QueryBudgetExceeded
+import io
+from datetime import date
+
+import pytest
+
+import app as finance
+
+MONTH = date.today().strftime('%Y-%m')
+CSV_BODY = '﻿日期,收支類型,主分類,細項,金額,消費情緒,備註\n2024-05-01,支出,餐飲,早餐,80,😐 需要,\n'.encode('utf-8')
+
+
+def add_transaction(client, amount=50, t_type='expense', mood='neutral'):
+    r = client.post('/', data={'amount': str(amount), 'type': t_type, 'main_category': '餐飲', 'item_name': '午餐', 'note': '', 'mood': mood, 'date': date.today().isoformat()})
+    assert r.status_code == 302
+
+
+def drop_aggregates(app, user_id, balance=True, rollups=True):
+    with app.app_context():
+        if balance: finance.UserBalance.query.filter_by(user_id=user_id).delete()
+        if rollups: finance.MonthlyRollup.query.filter_by(user_id=user_id).delete()
+        finance.db.session.commit()
+
+
+def test_budget_is_enforced(app, login, monkeypatch):
+    client = login()
+    monkeypatch.setattr(finance.api_ledger, 'query_budget', 1)
+    with pytest.raises(finance.QueryBudgetExceeded):
+        client.get('/api/ledger')
+
+
+def test_index_get_new_user(login):
+    # 新帳號第一次開首頁：沒有 UserBalance，需要懶重建
+    assert login().get('/').status_code == 200
+
+
+def test_index_post_first_transaction(login):
+    # 第一筆交易：餘額與該月彙總都要重建，並檢查「記帳新手」
+    add_transaction(login())
+
+
+def test_index_warm(login):
+    client = login()
+    add_transaction(client)
+    add_transaction(client, amount=20, mood='regret')
+    assert client.get(f'/?month={MONTH}').status_code == 200
+
+
+def test_index_get_rebuilds_missing_balance(app, login):
+    client = login()
+    add_transaction(client)
+    drop_aggregates(app, client.user_id)
+    assert client.get(f'/?month={MONTH}').status_code == 200
+    add_transaction(client)
+
+
+def test_ledger_and_details(login):
+    client = login()
+    add_transaction(client)
+    assert len(client.get(f'/api/ledger?month={MONTH}').get_json()['items']) == 1
+    assert len(client.get(f'/analysis/details?month={MONTH}&type=expense&category=餐飲').get_json()['items']) == 1
+
+
+@pytest.mark.parametrize('premium', [True, False])
+def test_analysis_warm(login, premium):
+    client = login(premium)
+    add_transaction(client)
+    assert client.get(f'/analysis?month={MONTH}').status_code == 200
+
+
+def test_analysis_rebuilds_missing_rollups(app, login):
+    client = login()
+    add_transaction(client)
+    drop_aggregates(app, client.user_id, balance=False)
+    assert client.get(f'/analysis?month={MONTH}').status_code == 200
+
+
+@pytest.mark.parametrize('path', ['/trends?months=12', '/api/trends?months=60'])
+def test_trends_cold_and_warm(app, login, path):
+    client = login()
+    add_transaction(client)
+    drop_aggregates(app, client.user_id, balance=False)
+    assert client.get(path).status_code == 200
+    assert client.get(path).status_code == 200
+
+
+def test_sync_pull(login):
+    client = login()
+    for _ in range(3): add_transaction(client)
+    first = client.get('/api/v1/sync?limit=2').get_json()
+    assert first['has_more']
+    rest = client.get('/api/v1/sync?limit=2&page=' + first['next_page']).get_json()
+    assert len(first['changes']['transactions']) + len(rest['changes']['transactions']) == 3
+    assert client.get(f"/api/v1/sync?cursor={first['cursor']}").get_json()['changes']['transactions'] == []
+
+
+def test_settings(login):
+    assert login().get('/settings').status_code == 200
+    client = login()
+    add_transaction(client)
+    client.post('/update_budget', data={'budget_餐飲': '3000'})
+    assert client.get('/settings').status_code == 200
+
+
+def test_job_routes(app, login):
+    client = login()
+    add_transaction(client)
+    export = client.get('/export_csv?format=json')
+    assert export.status_code == 202
+    assert client.post('/import_csv?format=json', data={'file': (io.BytesIO(CSV_BODY), 'import.csv')}).status_code == 202
+    assert client.post('/jobs', json={'kind': 'rebuild_aggregates'}).status_code == 202
+    assert len(client.get('/jobs').get_json()['jobs']) == 3
+    with app.app_context(): assert finance.run_pending_jobs() == 3
+    job_id = export.get_json()['id']
+    assert client.get(f'/jobs/{job_id}').get_json()['status'] == 'done'
+    assert client.get(f'/jobs/{job_id}/download').status_code == 200
@@ -0,0 +1,56 @@
+# 同步 API 的寫入行為：推送後的 UserBalance / MonthlyRollup 要與從交易重新計算的結果一致
+from sqlalchemy import func
+
+import app as finance
+
+
+def tx(day, amount, category='餐飲', t_type='expense', mood='neutral'):
+    return {'date': day, 'type': t_type, 'main_category': category, 'item_name': '項目', 'amount': amount, 'mood': mood}
+
+
+def push(client, *creates, cursor=-1):
+    r = client.post('/api/v1/sync', json={'cursor': cursor, 'transactions': {'create': list(creates)}})
+    assert r.status_code == 200, r.get_json()
+    return r.get_json()
+
+
+def assert_aggregates_match(app, user_id):
+    with app.app_context():
+        bal = finance.db.session.get(finance.UserBalance, user_id)
+        assert (bal.income, bal.expense, bal.tx_count) == finance.compute_balance(user_id)
+        T = finance.AllTransaction
+        expected = {}
+        for d, t_type, cat, t_mood, amount in finance.db.session.query(T.date, T.type, T.main_category, func.coalesce(T.mood, 'neutral'), T.amount).filter(T.user_id == user_id):
+            total, n = expected.get((d.strftime('%Y-%m'), t_type, cat, t_mood), (0, 0))
+            expected[(d.strftime('%Y-%m'), t_type, cat, t_mood)] = (total + amount, n + 1)
+        R = finance.MonthlyRollup
+        stored = {(r.year_month, r.type, r.main_category, r.mood): (r.total, r.count) for r in R.query.filter(R.user_id == user_id, R.count > 0)}
+        assert stored == expected
+
+
+def test_push_batch_new_user(app, login):
+    client = login()
+    push(client, tx('2024-03-01', 10), tx('2024-03-02', 20), tx('2024-03-03', 30, category='交通'), tx('2024-03-04', 40, mood='regret'))
+    assert_aggregates_match(app, client.user_id)
+
+
+def test_push_batch_existing_user(app, login):
+    client = login()
+    first = push(client, tx('2024-03-01', 10), tx('2024-03-02', 500, category='薪資', t_type='income'))
+    push(client, tx('2024-03-05', 15), tx('2024-04-01', 1), tx('2024-04-02', 2), tx('2024-04-03', 3, category='交通'), cursor=first['cursor'])
+    assert_aggregates_match(app, client.user_id)
+
+
+def test_push_batch_with_delete(app, login):
+    client = login()
+    first = push(client, tx('2024-03-01', 10), tx('2024-03-02', 20))
+    ids = sorted(first['changes']['transactions'], key=lambda t: t['amount'])
+    r = client.post('/api/v1/sync', json={'cursor': first['cursor'], 'transactions': {'create': [tx('2024-03-03', 7), tx('2024-05-01', 9)], 'delete': [ids[0]['id']]}})
+    assert r.status_code == 200
+    assert_aggregates_match(app, client.user_id)
+
+
+def test_push_rejects_non_string_mood(login):
+    r = login().post('/api/v1/sync', json={'cursor': -1, 'transactions': {'create': [tx('2024-03-01', 10, mood=['a'])]}})
+    assert r.status_code == 400
+    assert r.get_json()['errors'][0]['error'] == '未知的消費情緒'